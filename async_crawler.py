@@ -0,0 +1,299 @@
+"""
+Asyncio crawl engine, an alternative to the thread pools of metadata_fetcher.py.
+Thousands of ranged requests can be in flight at the same time,
+limited globally, per host and per proxy.
+The EXIF parsing, hashing, comparison and saving run in a thread pool
+so they do not block the event loop.
+Select it with CRAWL_ENGINE = "asyncio" in settings.py.
+"""
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import aiohttp
+from aiohttp_socks import ProxyConnector, ProxyConnectionError
+from proxy_pool import error_chain
+from scheduler import DomainQuota
+from image_links import ImageLinkExtractor, charset_from_content_type
+import settings # Import the settings from settings.py
+import metadata_fetcher
+import metrics
+
+def is_proxy_failure(error):
+    """Async version of metadata_fetcher.is_proxy_failure."""
+    return any(isinstance(wrapped, (ProxyConnectionError, aiohttp.ClientProxyConnectionError))
+               for wrapped in error_chain(error))
+
+class AsyncCrawler:
+    """Crawl the URLs and save the image metadata like metadata_fetcher.main()."""
+
+    def __init__(self):
+        self.requests = asyncio.Semaphore(settings.ASYNC_MAX_REQUESTS)
+        self.host_limits = {} # Host -> [semaphore, requests waiting or in flight], dropped when idle
+        self.proxy_limits = defaultdict(lambda: asyncio.Semaphore(settings.ASYNC_MAX_PER_PROXY))
+        self.sessions = {} # Proxy index (None for direct) -> aiohttp.ClientSession
+        self.executor = ThreadPoolExecutor(max_workers=settings.MAX_THREADS)
+        self.timeout = aiohttp.ClientTimeout(total=60)
+        self.image_fetches = {} # Image URL -> task of the running fetch, shared by the pages
+        self.quota = DomainQuota(settings.MAX_IMG_PER_DOMAIN) # Images of the HTML pages per domain
+
+    def session(self, proxy_index):
+        """One client session per proxy, the connections are kept alive and reused."""
+        if proxy_index not in self.sessions:
+            if proxy_index is None:
+                connector = aiohttp.TCPConnector(limit=settings.ASYNC_MAX_REQUESTS,
+                                                 limit_per_host=settings.ASYNC_MAX_PER_HOST)
+            else:
+                # socks5h: resolve the onion address on the proxy side (rdns)
+                proxy_url = settings.PROXIES[proxy_index]["http"].replace("socks5h://", "socks5://")
+                connector = ProxyConnector.from_url(proxy_url, rdns=True,
+                                                    limit=settings.ASYNC_MAX_PER_PROXY,
+                                                    limit_per_host=settings.ASYNC_MAX_PER_HOST)
+            headers = {"User-Agent": settings.USER_AGENT} if getattr(settings, "USER_AGENT", None) else {}
+            self.sessions[proxy_index] = aiohttp.ClientSession(
+                connector=connector, headers=headers, timeout=self.timeout)
+        return self.sessions[proxy_index]
+
+    @asynccontextmanager
+    async def host_limit(self, host):
+        """Per-host limit, the semaphore of a host is dropped once it has no request."""
+        limit = self.host_limits.get(host)
+        if limit is None:
+            limit = self.host_limits[host] = [asyncio.Semaphore(settings.ASYNC_MAX_PER_HOST), 0]
+        limit[1] += 1
+        try:
+            async with limit[0]:
+                yield
+        finally:
+            limit[1] -= 1
+            if not limit[1]:
+                del self.host_limits[host]
+
+    @asynccontextmanager
+    async def limited(self, url, stage):
+        """
+        Session for a request within the global, per-host and per-proxy limits,
+        the per-proxy limit applies only to the requests through a proxy.
+        The outcome of a request through a proxy is recorded in metadata_fetcher.PROXY_POOL,
+        the request is timed as the stage in the metrics.
+        """
+        proxy_index = metadata_fetcher.proxy_index_for_url(url)
+        host = urlparse(url).netloc.lower()
+        async with self.requests, self.host_limit(host):
+            if proxy_index is None:
+                with metrics.timer(stage, host):
+                    yield self.session(None)
+                return
+            async with self.proxy_limits[proxy_index]:
+                proxy_pool = metadata_fetcher.PROXY_POOL
+                start = proxy_pool.begin(proxy_index)
+                try:
+                    with metrics.timer(stage, host, proxy_pool.keys[proxy_index]):
+                        yield self.session(proxy_index)
+                except Exception as error:
+                    proxy_pool.end(proxy_index, start, error, is_proxy_failure)
+                    raise
+                proxy_pool.end(proxy_index, start)
+
+    async def failover(self, url, request):
+        """Async version of metadata_fetcher.failover, request is a coroutine function."""
+        for _ in range(settings.PROXY_RETRIES):
+            try:
+                return await request()
+            except Exception as error:
+                if metadata_fetcher.proxy_index_for_url(url) is None or not is_proxy_failure(error):
+                    raise
+        return await request()
+
+    async def request(self, method, url, stage, headers=None, limit=None):
+        """
+        Send a request within the global, per-host and per-proxy limits, timed as the stage.
+        Returns (status, lowercase headers, body), at most limit bytes of the body are read.
+        """
+        async def send():
+            async with self.limited(url, stage) as session:
+                async with session.request(method, url, headers=headers, allow_redirects=True) as response:
+                    response_headers = {k.lower(): v for k, v in response.headers.items()}
+                    body = b""
+                    if method == "GET":
+                        if limit is None:
+                            body = await response.read()
+                        else:
+                            while len(body) < limit:
+                                chunk = await response.content.read(limit - len(body))
+                                if not chunk:
+                                    break
+                                body += chunk
+                            if len(body) >= limit and not response.content.at_eof():
+                                response.close() # Do not read the rest of the file
+                    return response.status, response_headers, body
+        return await self.failover(url, send)
+
+    async def head(self, url):
+        """Send a HEAD request, returns the lowercase headers or {} on failure."""
+        try:
+            status, headers, _ = await self.request("HEAD", url, "head")
+            return headers if status in [200, 206] else {}
+        except Exception:
+            return {}
+
+    async def ranged_get(self, url, start, end, validators=None):
+        """Async version of metadata_fetcher.ranged_get."""
+        limit = end - start + 1
+        try:
+            # A 200 response ignores the range and starts from 0
+            status, headers, body = await self.request(
+                "GET", url, "image_get", headers={"Range": f"bytes={start}-{end}", **(validators or {})},
+                limit=start + limit)
+        except Exception:
+            return {}, b"", 0
+        if status == 304: # The cached fingerprint is still valid
+            return headers, None, 0
+        if status not in [200, 206]:
+            return {}, b"", 0
+        body = body[start:start + limit] if status == 200 else body[:limit]
+        metrics.count("image_bytes", len(body), metadata_fetcher.url_domain(url))
+        total_size = metadata_fetcher.total_size_from_headers(status, headers)
+        if not total_size and status == 200 and len(body) < limit:
+            total_size = start + len(body) # The whole body was read
+        return headers, body, total_size
+
+    async def run_blocking(self, func, *args):
+        """Run CPU or disk work in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, metrics.profiled, func, *args)
+
+    async def fetch_img(self, img_tag, base_url, test_head=None):
+        """Async version of metadata_fetcher.fetch_img, the pages share the running fetch of an image."""
+        img_url = metadata_fetcher.resolve_img_url(img_tag, base_url)
+        if not img_url:
+            return None
+        task = self.image_fetches.get(img_url)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch_image_url(img_url, test_head))
+            self.image_fetches[img_url] = task
+            task.add_done_callback(lambda _: self.image_fetches.pop(img_url, None))
+        return await asyncio.shield(task) # A cancelled page does not cancel the fetch of the others
+
+    async def fetch_image_url(self, img_url, test_head=None):
+        """Async version of metadata_fetcher.fetch_image_url."""
+        entry = await self.run_blocking(metadata_fetcher.cache_entry, img_url)
+        if metadata_fetcher.is_fresh(entry):
+            return await self.run_blocking(metadata_fetcher.cached_image_metadata, img_url, entry)
+        start_bytes = None
+        if not test_head and settings.SINGLE_REQUEST_FETCH:
+            test_head, start_bytes, total_size = await self.ranged_get(
+                img_url, 0, metadata_fetcher.probe_end(), entry.validators() if entry else None)
+            if start_bytes is None and entry: # 304 Not Modified
+                return await self.run_blocking(
+                    metadata_fetcher.cached_image_metadata, img_url, entry, True)
+            if start_bytes and not total_size: # Size is still unknown, ask it for the size filtering
+                head_response = await self.head(img_url)
+                total_size = int(head_response.get("content-length", "0"))
+                test_head = {**head_response, **test_head}
+        else:
+            if not test_head:
+                test_head = await self.head(img_url)
+            if entry and entry.matches(test_head): # Same etag or Last-Modified
+                return await self.run_blocking(
+                    metadata_fetcher.cached_image_metadata, img_url, entry, True)
+            total_size = int(test_head.get("content-length", "0"))
+        if total_size < settings.MIN_IMAGE_SIZE:  # Ignore small images
+            start_bytes = None
+        elif start_bytes is None:
+            start_bytes = (await self.ranged_get(img_url, 0, metadata_fetcher.probe_end()))[1]
+        if start_bytes and settings.ADAPTIVE_PROBE:
+            follow_up = metadata_fetcher.follow_up_range(start_bytes, total_size)
+            if follow_up: # At most one more request
+                start_bytes += (await self.ranged_get(img_url, *follow_up))[1]
+        failed = metadata_fetcher.download_failed(start_bytes, total_size)
+        if failed:
+            print(f"Failed to download the first bytes of the image: {img_url}", flush=True)
+            start_bytes = None
+        metadata = await self.run_blocking(
+            metadata_fetcher.image_metadata, img_url, test_head, total_size, start_bytes)
+        if not failed: # A failed download is tried again by the next crawl
+            await self.run_blocking(metadata_fetcher.cache_image_metadata, img_url, test_head, metadata)
+        return metadata
+
+    async def fetch_images(self, img_tags, base_url, test_head=None):
+        """Process the images of a page concurrently and save the results."""
+        tasks = [self.fetch_img(img, base_url, test_head)
+                 for img in img_tags[:settings.MAX_IMG_PER_DOMAIN]]
+        results = [result for result in await asyncio.gather(*tasks) if result]
+        await self.run_blocking(metadata_fetcher.save_results, results, base_url)
+
+    async def download_image_metadata(self, resource_url):
+        """Async version of metadata_fetcher.crawl_page."""
+        test_head = await self.head(resource_url)
+        if "image" in test_head.get("content-type", ""): # Image link
+            await self.fetch_images([resource_url], resource_url, test_head)
+        elif settings.HTML_PARSING and "html" in test_head.get("content-type", ""): # HTML page
+            img_urls = self.quota.allow(metadata_fetcher.url_domain(resource_url),
+                                        await self.page_image_urls(resource_url))
+            await self.fetch_images(img_urls, resource_url)
+
+    async def page_image_urls(self, resource_url):
+        """Async version of metadata_fetcher.page_image_urls."""
+        async def get():
+            async with self.limited(resource_url, "page_get") as session:
+                async with session.get(resource_url, allow_redirects=True) as response:
+                    if response.status != 200:
+                        raise Exception(f"Failed to fetch URL: {resource_url}")
+                    extractor = ImageLinkExtractor(
+                        resource_url, settings.MAX_IMG_PER_DOMAIN,
+                        charset_from_content_type(response.headers.get("content-type", "")))
+                    async for chunk in response.content.iter_chunked(16384):
+                        if extractor.feed_bytes(chunk) or extractor.bytes_read >= settings.HTML_MAX_BYTES:
+                            response.close() # Do not read the rest of the page
+                            break
+                    else:
+                        extractor.close()
+                    metrics.count("page_bytes", extractor.bytes_read, metadata_fetcher.url_domain(resource_url))
+            return extractor.urls
+        return await self.failover(resource_url, get)
+
+    async def crawl(self, url_feed):
+        """
+        Crawl the URLs of the feed, ASYNC_MAX_PAGES at a time, and close the sessions.
+        A page error stops the crawl like the threads engine, the other pages are cancelled.
+        """
+        urls = iter(url_feed)
+        feed_lock = asyncio.Lock() # The feed is a generator, read by one worker at a time
+        async def worker():
+            while True:
+                async with feed_lock: # Read only when a worker is free, the index lookups are blocking
+                    url = await self.run_blocking(next, urls, None)
+                if url is None:
+                    return
+                try:
+                    await self.download_image_metadata(url)
+                except asyncio.CancelledError:
+                    raise # Unfinished, the checkpoint stays before it
+                except Exception:
+                    url_feed.done(url) # Failed, like in the threads engine
+                    raise
+                url_feed.done(url)
+        workers = [asyncio.ensure_future(worker()) for _ in range(settings.ASYNC_MAX_PAGES)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for session in self.sessions.values():
+                await session.close()
+            self.executor.shutdown(wait=True)
+
+async def crawl(url_feed):
+    """Create the crawler inside the event loop and crawl the URLs."""
+    await AsyncCrawler().crawl(url_feed)
+
+def crawl_urls(url_feed):
+    """Crawl the URLs of a url_index.UrlFeed with the asyncio engine."""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(crawl(url_feed))
+    finally:
+        loop.close()
@@ -0,0 +1,420 @@
+"""
+Reproducible benchmarks of the fetch and comparison pipeline.
+A synthetic corpus of metadata JSON files and a site of test JPEGs with EXIF are generated from a seed,
+the site is served by a local HTTP stand-in server with a configurable latency, Range and etag behaviour.
+Each case runs in a fresh process, the timings are written to a JSON file:
+python benchmark.py run --sizes 1000 10000 100000 --output benchmark.json
+python benchmark.py run --baseline benchmark.json # Compare with an earlier run
+python benchmark.py corpus ./bench_data/ --files 10000
+python benchmark.py serve ./bench_site/ --port 8000 --latency 0.05 --etag weak
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+from glob import glob
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import piexif
+from PIL import Image
+import settings # Import the settings from settings.py
+
+CAMERAS = (("Canon", "Canon EOS 5D"), ("NIKON CORPORATION", "NIKON D750"), ("Apple", "iPhone 12"),
+           ("SONY", "ILCE-7M3"), ("FUJIFILM", "X-T3"))
+SLOWER = 1.2 # A case this many times slower than the baseline is reported as a regression
+
+def file_path_from_url(url):
+    """Folder and file name of the metadata JSON file of a page, like metadata_fetcher.file_path_from_url."""
+    import metadata_fetcher # Imported here, the measured processes set the settings first
+    return metadata_fetcher.file_path_from_url(url)
+
+def synthetic_exif(rng):
+    """EXIF fields like the ones of the crawled images."""
+    make, model = rng.choice(CAMERAS)
+    return {
+        "Image Make": make,
+        "Image Model": model,
+        "Image Orientation": "Horizontal (normal)",
+        "Image DateTime": f"20{rng.randint(10, 25)}:{rng.randint(1, 12):02d}:{rng.randint(1, 28):02d} 12:00:00",
+        "EXIF ExposureTime": f"1/{rng.choice((60, 125, 250, 500))}",
+        "EXIF FNumber": f"{rng.randint(14, 110)}/10",
+        "EXIF ExifImageWidth": str(rng.choice((4000, 6000))),
+        "EXIF ExifImageLength": str(rng.choice((3000, 4000))),
+    }
+
+def synthetic_image(rng):
+    """Fingerprint fields of a random image: (sha256, sample, etag, thumbnail phash)."""
+    return (f"{rng.getrandbits(256):064x}", f"{rng.getrandbits(1024):0256x}",
+            f"{rng.getrandbits(48):012x}", f"{rng.getrandbits(64):016x}")
+
+def generate_corpus(folder, files, images_per_file=10, duplicate_rate=0.05, seed=1):
+    """
+    Write files metadata JSON files into <folder><domain>/, like the crawler does.
+    A duplicate_rate fraction of the images are copies of a shared pool, found on other domains.
+    """
+    rng = random.Random(seed)
+    shared = [synthetic_image(rng) for _ in range(max(1, files // 10))]
+    domains = max(1, files // 20)
+    for index in range(files):
+        page_url = f"http://site{index % domains}.example/page{index}.html"
+        records = []
+        for position in range(images_per_file):
+            sha256, sample, etag, phash = (rng.choice(shared) if rng.random() < duplicate_rate
+                                           else synthetic_image(rng))
+            records.append({
+                "url": f"http://site{index % domains}.example/images/{index}_{position}.jpg",
+                "image_size": rng.randint(settings.MIN_IMAGE_SIZE, 5000000),
+                "etag": etag,
+                "timestamp": "2025-11-03T10:14:42",
+                "exif": synthetic_exif(rng),
+                "sha256_first_10240_bytes": sha256,
+                "random_128_bytes_sample_start": sample,
+                "thumbnail_phash": phash,
+            })
+        domain_folder, filename = file_path_from_url(page_url)
+        os.makedirs(f"{folder}{domain_folder}", exist_ok=True)
+        with open(f"{folder}{domain_folder}/{filename}.json", "w", encoding="utf-8") as json_file:
+            json.dump(records, json_file, indent=4)
+
+def test_jpeg(seed, width=800, height=600):
+    """A noisy test JPEG above MIN_IMAGE_SIZE, with EXIF and an EXIF thumbnail."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    phases = rng.random((3, 3))
+    pixels = 127 + 60 * np.sin(2 * np.pi * (3 * x + phases[0])) * np.cos(2 * np.pi * (2 * y + phases[1]))
+    pixels = pixels + rng.normal(0, 25, (height, width, 3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    thumbnail = img.copy()
+    thumbnail.thumbnail((160, 120))
+    thumbnail_bytes = io.BytesIO()
+    thumbnail.save(thumbnail_bytes, "JPEG", quality=75)
+    make, model = CAMERAS[seed % len(CAMERAS)]
+    exif = piexif.dump({
+        "0th": {piexif.ImageIFD.Make: make.encode(), piexif.ImageIFD.Model: model.encode()},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2024:01:01 12:00:00"},
+        "1st": {piexif.ImageIFD.JPEGInterchangeFormat: 0, piexif.ImageIFD.JPEGInterchangeFormatLength: 0},
+        "thumbnail": thumbnail_bytes.getvalue(),
+    })
+    output = io.BytesIO()
+    img.save(output, "JPEG", quality=90, exif=exif)
+    return output.getvalue()
+
+def generate_site(folder, images=50, images_per_page=10, seed=1):
+    """Write test JPEGs into <folder>images/ and HTML pages linking them, returns the page paths."""
+    os.makedirs(f"{folder}images", exist_ok=True)
+    for index in range(images):
+        with open(f"{folder}images/img{index}.jpg", "wb") as image_file:
+            image_file.write(test_jpeg(seed * 100003 + index))
+    pages = []
+    for page, start in enumerate(range(0, images, images_per_page)):
+        tags = "\n".join(f'<img src="images/img{index}.jpg">'
+                         for index in range(start, min(start + images_per_page, images)))
+        with open(f"{folder}page{page}.html", "w", encoding="utf-8") as html_file:
+            html_file.write(f"<html><body>\n{tags}\n</body></html>\n")
+        pages.append(f"page{page}.html")
+    return pages
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve the files of root with a latency, optional Range support and etag behaviour."""
+    protocol_version = "HTTP/1.1"
+    root = "./"
+    latency = 0.0 # Seconds before each response
+    ranges = True # False ignores the Range header and sends the whole file
+    etag = "strong" # "strong", "weak" or "none"
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def do_HEAD(self):
+        """HEAD request."""
+        self.respond(head_only=True)
+
+    def do_GET(self):
+        """GET request."""
+        self.respond(head_only=False)
+
+    def send_body(self, status, headers, body, head_only):
+        """Send a response."""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body) if status != 304 else 0))
+        self.end_headers()
+        if not head_only and status != 304:
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError): # The client read only the start
+                self.close_connection = True
+
+    def respond(self, head_only):
+        """Serve a file, a 304 for a matching If-None-Match, a 206 for a Range."""
+        if self.latency:
+            time.sleep(self.latency)
+        file_path = os.path.join(self.root, self.path.split("?")[0].lstrip("/"))
+        if not os.path.isfile(file_path):
+            self.send_body(404, {}, b"", head_only)
+            return
+        with open(file_path, "rb") as served_file:
+            data = served_file.read()
+        headers = {"Content-Type": "text/html" if file_path.endswith(".html") else "image/jpeg",
+                   "Last-Modified": formatdate(os.path.getmtime(file_path), usegmt=True)}
+        if self.etag != "none":
+            etag = f'"{hashlib.md5(data).hexdigest()[:16]}"'
+            headers["ETag"] = f"W/{etag}" if self.etag == "weak" else etag
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                self.send_body(304, headers, b"", head_only)
+                return
+        range_header = self.headers.get("Range", "")
+        if self.ranges and range_header.startswith("bytes="):
+            start, _, end = range_header[len("bytes="):].partition("-")
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            if start >= len(data):
+                self.send_body(416, {"Content-Range": f"bytes */{len(data)}"}, b"", head_only)
+                return
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            self.send_body(206, headers, data[start:end + 1], head_only)
+            return
+        self.send_body(200, headers, data, head_only)
+
+def start_server(root, port=0, latency=0.0, ranges=True, etag="strong"):
+    """Serve root in a background thread, returns the server, its port is server.server_address[1]."""
+    handler = type("Handler", (StandInHandler,),
+                   {"root": root, "latency": latency, "ranges": ranges, "etag": etag})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def max_rss_kb():
+    """Peak resident memory of the process in KB, None where it is not available."""
+    try:
+        import resource # Unix only
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def configure(data_folder, url_file=""):
+    """Settings of a measured process: only the benchmark data, no stores, caches or metrics."""
+    settings.DATA_FOLDER = data_folder
+    settings.ARCHIVE = []
+    settings.FINGERPRINT_STORE = None
+    settings.LOAD_PROCESSES = 1
+    settings.DETECT_FROM_STORE = False
+    settings.REPORT_STORE = None
+    settings.TEST_IMAGES_FOLDER = ""
+    settings.URL_FILE = url_file
+    settings.URL_INDEX = None
+    settings.FETCH_CACHE = None
+    settings.RESULT_FORMAT = "json"
+    settings.METRICS_FILE = None
+
+def measure(case, data_folder, site_folder, url_file, count, seed):
+    """Run one case in this process, returns (items, seconds)."""
+    configure(data_folder, url_file)
+    import metadata_fetcher # After configure(), it reads the settings at import
+    if case == "load_all_metadata":
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            records = len(metadata_fetcher.load_all_metadata())
+        return records, time.perf_counter() - start
+    if case == "compare_images":
+        with contextlib.redirect_stdout(io.StringIO()):
+            fingerprints = metadata_fetcher.load_all_metadata()
+        rng = random.Random(seed)
+        new_images = []
+        for index in range(count):
+            start_bytes = rng.randbytes(10241) if hasattr(rng, "randbytes") else os.urandom(10241)
+            metadata = {"url": f"http://new.example/images/{index}.jpg", "etag": f"{rng.getrandbits(48):012x}",
+                        "sha256_first_10240_bytes": hashlib.sha256(start_bytes).hexdigest(),
+                        "random_128_bytes_sample_start": start_bytes[-128:].hex(),
+                        "thumbnail_phash": f"{rng.getrandbits(64):016x}"}
+            if fingerprints and index % 2: # Half of the new images are copies of collected ones
+                metadata.update(rng.choice(fingerprints).summary())
+                metadata["url"] = f"http://new.example/images/{index}.jpg"
+            new_images.append((metadata, start_bytes))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for metadata, start_bytes in new_images:
+                metadata_fetcher.compare_images(metadata, start_bytes)
+        return count, time.perf_counter() - start
+    if case == "detect":
+        import detect_websites_sharing_same_images
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            detect_websites_sharing_same_images.main()
+        return len(glob(f"{data_folder}*/*.json")), time.perf_counter() - start
+    if case == "exif":
+        starts = []
+        for image_path in sorted(glob(f"{site_folder}images/*.jpg")):
+            with open(image_path, "rb") as image_file:
+                starts.append(image_file.read(metadata_fetcher.FINGERPRINT_SIZE))
+        start = time.perf_counter()
+        for index in range(count):
+            metadata_fetcher.extract_metadata(starts[index % len(starts)])
+        return count, time.perf_counter() - start
+    if case == "crawl":
+        import fingerprint_store
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            metadata_fetcher.main()
+        seconds = time.perf_counter() - start
+        images = sum(len(fingerprint_store.read_json_file(file_path))
+                     for file_path in glob(f"{data_folder}*/*.json"))
+        return images, seconds
+    raise ValueError(f"Unknown case: {case}")
+
+def run_case(case, size, data_folder, site_folder="", url_file="", count=0, seed=1):
+    """Run a case in a fresh process, returns its result dict."""
+    command = [sys.executable, os.path.abspath(__file__), "measure", case, data_folder,
+               "--site", site_folder, "--url-file", url_file, "--count", str(count), "--seed", str(seed)]
+    completed = subprocess.run(command, capture_output=True, text=True, check=False,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode:
+        raise RuntimeError(f"{case} failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result.update({"case": case, "size": size})
+    print(f"{case:<18} size {size:>8}  {result['items']:>8} items  {result['seconds']:>9.3f} s  "
+          f"{result['per_item'] * 1000:>9.3f} ms/item", flush=True)
+    return result
+
+def environment():
+    """Versions and commit of the run."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "numpy": np.__version__, "pillow": Image.__version__, "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def compare_with_baseline(results, baseline_path):
+    """Print the cases slower than in the baseline file, returns their count."""
+    with open(baseline_path, "r", encoding="utf-8") as baseline_file:
+        baseline = {(result["case"], result["size"]): result for result in json.load(baseline_file)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get((result["case"], result["size"]))
+        if not before or not before["per_item"]:
+            continue
+        ratio = result["per_item"] / before["per_item"]
+        if ratio > SLOWER:
+            regressions += 1
+            print(f"Regression: {result['case']} size {result['size']} is {ratio:.2f}x slower", flush=True)
+    print(f"{regressions} regressions against {baseline_path}", flush=True)
+    return regressions
+
+def run(args):
+    """Generate the data, run all cases and write the results."""
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    workdir = os.path.join(os.path.abspath(workdir), "")
+    results = []
+    server = None
+    try:
+        site_folder = f"{workdir}site/"
+        pages = generate_site(site_folder, args.images, seed=args.seed)
+        server = start_server(site_folder, latency=args.latency, ranges=not args.no_range, etag=args.etag)
+        url_file = f"{workdir}urls.txt"
+        with open(url_file, "w", encoding="utf-8") as urls:
+            urls.write("".join(f"http://127.0.0.1:{server.server_address[1]}/{page}\n" for page in pages))
+        results.append(run_case("exif", 0, f"{workdir}empty/", site_folder, count=args.exif, seed=args.seed))
+        shutil.rmtree(f"{workdir}crawl/", ignore_errors=True)
+        results.append(run_case("crawl", 0, f"{workdir}crawl/", site_folder, url_file, seed=args.seed))
+        for size in args.sizes:
+            corpus = f"{workdir}corpus-{size}/"
+            if not os.path.isdir(corpus):
+                generate_corpus(corpus, size, seed=args.seed)
+            results.append(run_case("load_all_metadata", size, corpus, seed=args.seed))
+            results.append(run_case("compare_images", size, corpus, count=args.compares, seed=args.seed))
+            results.append(run_case("detect", size, corpus, seed=args.seed))
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {"environment": environment(),
+              "parameters": {"sizes": args.sizes, "images": args.images, "compares": args.compares,
+                             "exif": args.exif, "latency": args.latency, "ranges": not args.no_range,
+                             "etag": args.etag, "seed": args.seed},
+              "results": results}
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=4)
+    print(f"Wrote {args.output}", flush=True)
+
+def main(argv=None):
+    """ Main """
+    parser = argparse.ArgumentParser(description="Benchmarks with a synthetic corpus and a local HTTP server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="generate the data and time all cases")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                            help="corpus sizes in metadata JSON files")
+    run_parser.add_argument("--images", type=int, default=50, help="test JPEGs of the served site")
+    run_parser.add_argument("--compares", type=int, default=200, help="new images compared per corpus size")
+    run_parser.add_argument("--exif", type=int, default=2000, help="EXIF extractions")
+    run_parser.add_argument("--latency", type=float, default=0.01, help="server latency in seconds")
+    run_parser.add_argument("--no-range", action="store_true", help="the server ignores Range")
+    run_parser.add_argument("--etag", choices=("strong", "weak", "none"), default="strong")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--workdir", help="keep the generated data in this folder, reused by the next runs")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    corpus_parser = commands.add_parser("corpus", help="generate a synthetic corpus of metadata JSON files")
+    corpus_parser.add_argument("folder")
+    corpus_parser.add_argument("--files", type=int, default=10000)
+    corpus_parser.add_argument("--images-per-file", type=int, default=10)
+    corpus_parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    corpus_parser.add_argument("--seed", type=int, default=1)
+    serve_parser = commands.add_parser("serve", help="generate a site of test JPEGs and serve it")
+    serve_parser.add_argument("folder")
+    serve_parser.add_argument("--images", type=int, default=50)
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--latency", type=float, default=0.0)
+    serve_parser.add_argument("--no-range", action="store_true")
+    serve_parser.add_argument("--etag", choices=("strong", "weak", "none"), default="strong")
+    serve_parser.add_argument("--seed", type=int, default=1)
+    measure_parser = commands.add_parser("measure", help=argparse.SUPPRESS) # One case, run by "run"
+    measure_parser.add_argument("case")
+    measure_parser.add_argument("data_folder")
+    measure_parser.add_argument("--site", default="")
+    measure_parser.add_argument("--url-file", default="")
+    measure_parser.add_argument("--count", type=int, default=0)
+    measure_parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+    elif args.command == "corpus":
+        folder = os.path.join(args.folder, "")
+        generate_corpus(folder, args.files, args.images_per_file, args.duplicate_rate, args.seed)
+        print(f"Generated {args.files} metadata files in {folder}", flush=True)
+    elif args.command == "serve":
+        folder = os.path.join(os.path.abspath(args.folder), "")
+        pages = generate_site(folder, args.images, seed=args.seed)
+        server = start_server(folder, args.port, args.latency, not args.no_range, args.etag)
+        for page in pages:
+            print(f"http://127.0.0.1:{server.server_address[1]}/{page}", flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        items, seconds = measure(args.case, args.data_folder, args.site, args.url_file, args.count, args.seed)
+        print(json.dumps({"items": items, "seconds": round(seconds, 6),
+                          "per_item": seconds / items if items else 0.0, "max_rss_kb": max_rss_kb()}))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,13 +1,20 @@
 """
 Detect shared image files across domains based on 'sha256_first_10240_bytes'
-from JSON metadata files (e.g., ./archive/**.json).
+from JSON metadata files (e.g., ./archive/**.json) and result segments.
 Output: groups of domains that share identical image samples.
 """
+import os
 import json
-from glob import glob
+import sqlite3
 from collections import defaultdict
+from itertools import islice, chain
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse
 import settings # Import the settings from settings.py
+import fingerprint_store
+import result_segments
+
+FILES_PER_TASK = 500 # JSON files parsed by a worker process at once
 
 def extract_domain_from_url(url):
     """Extract main domain part, e.g., 'example.org' -> 'example'"""
@@ -18,18 +25,26 @@ def extract_domain_from_url(url):
             return parts[-2]  # main part before TLD
         return parts[0]
     if url.count("/") > 1:
-        return host.split("/")[-2]
+        return url.split("/")[-2]
     print(f"Error with URL/filepath {url}", flush=True)
     return None
 
-def load_hashes():
-    """Load sha256_first_10240_bytes from all JSON files and map to domains."""
+def iter_json_files(folder):
+    """Walk the folder recursively and yield the JSON file paths as they are found."""
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_json_files(entry.path)
+        elif entry.name.endswith(".json"):
+            yield entry.path
+
+def parse_hashes(file_paths):
+    """Parse JSON files into a partial map of hash -> domains, run in a worker process."""
     hash_to_domains = defaultdict(set)
-    folders = settings.ARCHIVE + [settings.DATA_FOLDER]
-    json_files = []
-    for folder in folders:
-        json_files = json_files + glob(f"{folder}/**/*.json", recursive=True)
-    for file_path in json_files:
+    for file_path in file_paths:
         try:
             with open(file_path, "r", encoding="utf-8") as f:
                 data = json.load(f)
@@ -47,6 +62,65 @@ def load_hashes():
             print(f"Failed to parse {file_path}: {e}", flush=True)
     return hash_to_domains
 
+def parse_segment_hashes(segment_paths):
+    """Map the hashes of result segments to domains, run in a worker process."""
+    hash_to_domains = defaultdict(set)
+    for _, _, images in result_segments.iter_records(segment_paths):
+        for url, sha256_digest, *_ in images:
+            if not sha256_digest or not url:
+                continue
+            h = sha256_digest.hex() if isinstance(sha256_digest, bytes) else sha256_digest
+            hash_to_domains[h].add(extract_domain_from_url(url))
+    return hash_to_domains
+
+def merge_hashes(hash_to_domains, partial):
+    """Merge a partial map of hash -> domains."""
+    for h, domains in partial.items():
+        hash_to_domains[h] |= domains
+
+def load_hashes_from_store(store_path):
+    """Map hashes to domains from the fingerprint store, only new or changed JSON files are parsed."""
+    hash_to_domains = defaultdict(set)
+    connection = fingerprint_store.connect(store_path)
+    try:
+        fingerprint_store.update_store(connection, fingerprint_store.metadata_file_paths())
+        for h, url in connection.execute("SELECT sha256, url FROM records"):
+            if h and url:
+                hash_to_domains[h].add(extract_domain_from_url(url))
+    finally:
+        connection.close()
+    merge_hashes(hash_to_domains, parse_segment_hashes(result_segments.all_segment_paths()))
+    return hash_to_domains
+
+def load_hashes():
+    """
+    Load sha256_first_10240_bytes from all JSON files and result segments and map to domains.
+    The files are streamed from the directory walker to settings.LOAD_PROCESSES worker processes,
+    their partial maps are merged. The segments are scanned together, a later record replaces
+    an earlier record of the same page.
+    """
+    hash_to_domains = defaultdict(set)
+    folders = settings.ARCHIVE + [settings.DATA_FOLDER]
+    json_files = (path for folder in folders for path in iter_json_files(folder))
+    tasks = chain(((parse_hashes, file_paths)
+                   for file_paths in iter(lambda: list(islice(json_files, FILES_PER_TASK)), [])),
+                  [(parse_segment_hashes, result_segments.all_segment_paths())])
+    if settings.LOAD_PROCESSES <= 1:
+        for parse, paths in tasks:
+            merge_hashes(hash_to_domains, parse(paths))
+        return hash_to_domains
+    with ProcessPoolExecutor(max_workers=settings.LOAD_PROCESSES) as executor:
+        pending = set()
+        for parse, paths in tasks:
+            pending.add(executor.submit(parse, paths))
+            if len(pending) >= 2 * settings.LOAD_PROCESSES: # Keep the walker just ahead of the workers
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge_hashes(hash_to_domains, future.result())
+        for future in pending:
+            merge_hashes(hash_to_domains, future.result())
+    return hash_to_domains
+
 def group_by_domain_sets(hash_to_domains):
     """
     Group hashes that are shared by the exact same set of domains.
@@ -59,11 +133,124 @@ def group_by_domain_sets(hash_to_domains):
             groups[key].append(h)
     return groups
 
-def main():
-    """ Main """
-    hash_to_domains = load_hashes()
-    grouped = group_by_domain_sets(hash_to_domains)
-    print(f"\nFound {len(grouped)} domain groups sharing identical images:\n", flush=True)
+REPORT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS report_pairs (
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    domain TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS report_pairs_path ON report_pairs (path);
+CREATE INDEX IF NOT EXISTS report_pairs_sha256 ON report_pairs (sha256);
+CREATE TABLE IF NOT EXISTS report_hashes (
+    sha256 TEXT PRIMARY KEY,
+    domains TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS report_hashes_domains ON report_hashes (domains);
+"""
+
+def domains_key(domains):
+    """Stored key of a domain set, the sorted domains one per line."""
+    return "\n".join(sorted(domains))
+
+def update_report_store(connection):
+    """
+    Apply the JSON files added, changed or deleted since the last run to the stored
+    hash -> domains map. Returns the domain keys of the groups that changed.
+    A result segment record is stored under its location, like a file that never changes,
+    a later record of the same key replaces it like a deleted file.
+    """
+    known = {path: (mtime_ns, size) for path, mtime_ns, size
+             in connection.execute("SELECT path, mtime_ns, size FROM report_files")}
+    folders = settings.ARCHIVE + [settings.DATA_FOLDER]
+    changed = []
+    for folder in folders:
+        for file_path in iter_json_files(folder):
+            try:
+                if known.pop(file_path, None) == fingerprint_store.file_signature(file_path):
+                    continue # Unchanged since the last run
+            except OSError:
+                pass
+            changed.append(file_path)
+    new_records = [] # (location, images) of the segment records not applied yet
+    for record_location, _, images in result_segments.iter_records(result_segments.all_segment_paths()):
+        if known.pop(record_location, None) is None:
+            new_records.append((record_location, images))
+    touched = set() # Hashes of the changed files, before and after the change
+    def drop_file(file_path):
+        touched.update(h for (h,) in connection.execute(
+            "SELECT sha256 FROM report_pairs WHERE path = ?", (file_path,)))
+        connection.execute("DELETE FROM report_pairs WHERE path = ?", (file_path,))
+        connection.execute("DELETE FROM report_files WHERE path = ?", (file_path,))
+    def add_file(file_path, signature, pairs):
+        touched.update(h for h, _ in pairs)
+        connection.executemany("INSERT INTO report_pairs (path, sha256, domain) VALUES (?, ?, ?)",
+                               [(file_path, h, domain) for h, domain in pairs])
+        connection.execute("INSERT INTO report_files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                           (file_path, signature[0], signature[1]))
+    for file_path in known: # Deleted files and replaced segment records
+        drop_file(file_path)
+    for file_path, signature, rows, error in fingerprint_store.parse_files(changed):
+        drop_file(file_path)
+        if error is not None:
+            print(f"Failed to parse {file_path}: {error}", flush=True)
+            continue
+        pairs = set()
+        for _, url, h, *_ in rows:
+            domain = extract_domain_from_url(url) if h and url else None
+            if domain:
+                pairs.add((h, domain))
+        add_file(file_path, signature, pairs)
+    for record_location, images in new_records:
+        pairs = set()
+        for url, sha256_digest, *_ in images:
+            h = sha256_digest.hex() if isinstance(sha256_digest, bytes) else sha256_digest
+            domain = extract_domain_from_url(url) if h and url else None
+            if domain:
+                pairs.add((h, domain))
+        add_file(record_location, (0, 0), pairs)
+    changed_groups = set()
+    for h in touched:
+        row = connection.execute("SELECT domains FROM report_hashes WHERE sha256 = ?", (h,)).fetchone()
+        old_key = row[0] if row else ""
+        domains = {domain for (domain,) in connection.execute(
+            "SELECT domain FROM report_pairs WHERE sha256 = ?", (h,))}
+        new_key = domains_key(domains)
+        if new_key == old_key:
+            continue
+        if domains:
+            connection.execute("INSERT OR REPLACE INTO report_hashes (sha256, domains) VALUES (?, ?)",
+                               (h, new_key))
+        else:
+            connection.execute("DELETE FROM report_hashes WHERE sha256 = ?", (h,))
+        changed_groups.update(key for key in (old_key, new_key) if "\n" in key) # Shared by 2+ domains
+    connection.commit()
+    print(f"Applied {len(changed)} new or changed JSON files, {len(new_records)} new segment records "
+          f"and {len(known)} deleted files or replaced records.", flush=True)
+    return changed_groups
+
+def load_report_groups(connection, keys=None):
+    """Groups of frozenset(domains) -> [hashes] from the report store, all or only the given keys."""
+    groups = defaultdict(list)
+    if keys is None:
+        rows = connection.execute("SELECT domains, sha256 FROM report_hashes WHERE domains LIKE '%' || char(10) || '%'")
+    else:
+        rows = (row for key in keys for row in connection.execute(
+            "SELECT domains, sha256 FROM report_hashes WHERE domains = ?", (key,)))
+    for key, h in rows:
+        groups[frozenset(key.split("\n"))].append(h)
+    if keys is not None: # Groups that no longer have any hashes
+        for key in keys:
+            groups.setdefault(frozenset(key.split("\n")), [])
+    return groups
+
+def print_groups(grouped, title):
+    """Print the domain groups, the largest first."""
+    print(f"\n{title.format(len(grouped))}\n", flush=True)
     for domains, hashes in sorted(grouped.items(), key=lambda x: -len(x[1])):
         print("-" * 80)
         print(f"{len(hashes)} identical images between the domains:", flush=True)
@@ -74,5 +261,43 @@ def main():
             print(d)
         print("-" * 80)
 
+def export_groups(grouped, file_path):
+    """Write the domain groups into a JSON file."""
+    with open(file_path, "w", encoding="utf-8") as json_file:
+        json.dump([{"domains": sorted(domains), "hashes": hashes}
+                   for domains, hashes in sorted(grouped.items(), key=lambda x: -len(x[1]))],
+                  json_file, indent=4)
+    print(f"Exported {len(grouped)} domain groups into {file_path}", flush=True)
+
+def incremental_report():
+    """Update the report store and print (or export) the changed groups, or all groups on demand."""
+    connection = sqlite3.connect(settings.REPORT_STORE)
+    try:
+        connection.executescript(REPORT_SCHEMA)
+        changed_groups = update_report_store(connection)
+        if settings.REPORT_CHANGES_ONLY:
+            grouped = load_report_groups(connection, changed_groups)
+            title = "{} domain groups changed since the last run:"
+        else:
+            grouped = load_report_groups(connection)
+            title = "Found {} domain groups sharing identical images:"
+    finally:
+        connection.close()
+    print_groups(grouped, title)
+    if settings.REPORT_EXPORT:
+        export_groups(grouped, settings.REPORT_EXPORT)
+
+def main():
+    """ Main """
+    if settings.REPORT_STORE:
+        incremental_report()
+        return
+    if settings.DETECT_FROM_STORE and settings.FINGERPRINT_STORE:
+        hash_to_domains = load_hashes_from_store(settings.FINGERPRINT_STORE)
+    else:
+        hash_to_domains = load_hashes()
+    grouped = group_by_domain_sets(hash_to_domains)
+    print_groups(grouped, "Found {} domain groups sharing identical images:")
+
 if __name__ == "__main__":
     main()
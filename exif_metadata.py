@@ -0,0 +1,222 @@
+"""
+EXIF metadata extraction from the first bytes of an image file.
+The image format is sniffed from the magic bytes, and the start is sent only to
+the parsers that can handle the format.
+The extraction can run in a process pool, the image starts are sent in batches.
+"""
+import io
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import piexif
+import exifread
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+# Start method of the worker processes: the pool is created from a crawl thread,
+# and a fork of a multi-threaded process can deadlock on a lock held by another thread
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def extract_pil(start_bytes):
+    ''' Extract EXIF metadata '''
+    exif_data = {}
+    try:
+        img = Image.open(io.BytesIO(start_bytes))
+        exif_raw = img._getexif()
+        if exif_raw:
+            for tag, value in exif_raw.items():
+                # Convert EXIF values to JSON-serializable types
+                if isinstance(value, (bytes, bytearray)):
+                    value = value.decode(errors="ignore")  # Decode bytes if possible
+                else:
+                    value = str(value)  # Convert other types to string
+                exif_data[TAGS.get(tag, tag)] = value
+        return exif_data
+    except Exception:
+        return exif_data
+
+def extract_piexif(start_bytes):
+    """Extract EXIF metadata using piexif."""
+    exif_data = {}
+    try:
+        exif_dict = piexif.load(start_bytes)
+        for ifd_name in exif_dict:
+            json_data = sanitize_for_json(exif_dict[ifd_name])
+            for tag, value in json_data.items():
+                tag_name = piexif.TAGS[ifd_name][tag]["name"]
+                # Convert bytes to strings if necessary
+                if isinstance(value, bytes):
+                    try:
+                        value = value.decode(errors="ignore")  # Attempt to decode bytes
+                    except Exception:
+                        value = str(value)  # Fallback: Convert to string representation
+                exif_data[tag_name] = value
+        return exif_data
+    except Exception:
+        return exif_data
+
+def extract_metadata_with_exif_py(start_bytes):
+    """Extract EXIF metadata using the exif-py library."""
+    exif_data = {}
+    try:
+        # Parse EXIF tags from the given image bytes
+        tags = exifread.process_file(io.BytesIO(start_bytes), details=False)
+        for tag, value in tags.items():
+            # Convert tag values to strings to ensure JSON serialization
+            exif_data[tag] = str(value)
+        return exif_data
+    except Exception:
+        return exif_data
+
+def sanitize_for_json(obj):
+    """Recursively convert non-JSON-serializable types (like bytes) to strings."""
+    if isinstance(obj, bytes):
+        return obj.decode(errors="ignore")  # Convert bytes to string
+    if isinstance(obj, dict):
+        return {key: sanitize_for_json(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [sanitize_for_json(item) for item in obj]
+    return obj  # Return other types unchanged
+
+# ftyp brands of HEIF/HEIC/AVIF files
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif")
+
+def sniff_format(start_bytes):
+    """Image format from the magic bytes: jpeg, tiff, png, webp, heic or None."""
+    if start_bytes[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if start_bytes[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if start_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if start_bytes[:4] == b"RIFF" and start_bytes[8:12] == b"WEBP":
+        return "webp"
+    if start_bytes[4:8] == b"ftyp" and start_bytes[8:12] in HEIF_BRANDS:
+        return "heic"
+    return None
+
+def jpeg_metadata_end(start_bytes):
+    """
+    End offset of the metadata segments (APPn and COM) at the start of a JPEG.
+    The segment lengths are read from the headers, so the end can be beyond start_bytes.
+    Returns None if start_bytes is not a JPEG.
+    """
+    if sniff_format(start_bytes) != "jpeg":
+        return None
+    offset = 2 # After the SOI marker
+    while offset + 4 <= len(start_bytes) and start_bytes[offset] == 0xFF:
+        marker = start_bytes[offset + 1]
+        if marker == 0xFF: # Fill byte
+            offset += 1
+            continue
+        if not (0xE0 <= marker <= 0xEF or marker == 0xFE): # Not APPn or COM, image data follows
+            break
+        offset += 2 + int.from_bytes(start_bytes[offset + 2:offset + 4], "big")
+    return offset
+
+# Parsers that can read EXIF from each format, in the order of preference
+FORMAT_PARSERS = {
+    "jpeg": (extract_metadata_with_exif_py, extract_pil, extract_piexif),
+    "tiff": (extract_metadata_with_exif_py, extract_pil, extract_piexif),
+    "webp": (extract_metadata_with_exif_py, extract_pil, extract_piexif),
+    "png": (extract_metadata_with_exif_py, extract_pil),
+    "heic": (extract_metadata_with_exif_py,),
+    None: (extract_metadata_with_exif_py, extract_pil, extract_piexif), # Unknown, try all
+}
+
+def run_parsers(parsers, start_bytes):
+    """Return the EXIF metadata of the first parser that finds any."""
+    for parser in parsers:
+        exif_data = parser(start_bytes)
+        if exif_data:
+            return exif_data
+    return {}
+
+def extract_metadata(start_bytes):
+    """Extract EXIF metadata from the start of an image file."""
+    image_format = sniff_format(start_bytes)
+    exif_data = {}
+    # A JPEG without the "Exif" marker (APP1 segment) within the start has no EXIF for any parser
+    if image_format != "jpeg" or b"Exif" in start_bytes:
+        exif_data = run_parsers(FORMAT_PARSERS[image_format], start_bytes)
+    if not exif_data:
+        if b"Exif" in start_bytes: # Check for APP1 segment containing EXIF metadata
+            exif_start = start_bytes.find(b"Exif") + 6 # Start after "Exif\0\0"
+            start_bytes = start_bytes[exif_start:] # Extract potential EXIF segment
+            exif_data = run_parsers(FORMAT_PARSERS[None], start_bytes)
+    return exif_data
+
+def extract_metadata_batch(start_bytes_list):
+    """Extract EXIF metadata of many image starts, run in a worker process."""
+    return [extract_metadata(start_bytes) for start_bytes in start_bytes_list]
+
+class ExifBatcher:
+    """
+    Send the image starts to a process pool in batches.
+    A batch is sent when it has batch_size starts or batch_wait seconds after its first start.
+    """
+
+    def __init__(self, processes, batch_size=32, batch_wait=0.05):
+        self.executor = ProcessPoolExecutor(max_workers=processes,
+                                            mp_context=multiprocessing.get_context(START_METHOD))
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.pending = [] # (start_bytes, Future)
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def submit(self, start_bytes):
+        """Queue an image start, returns a Future of its EXIF metadata."""
+        future = Future()
+        batch = None
+        with self.lock:
+            self.pending.append((start_bytes, future))
+            if len(self.pending) >= self.batch_size:
+                batch = self.take_batch()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if batch:
+            self.dispatch(batch)
+        return future
+
+    def take_batch(self):
+        """Take the pending starts, call with the lock held."""
+        batch = self.pending
+        self.pending = []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def flush(self):
+        """Send the pending starts now."""
+        with self.lock:
+            batch = self.take_batch()
+        if batch:
+            self.dispatch(batch)
+
+    def dispatch(self, batch):
+        """Send a batch to the process pool and resolve the futures when it is done."""
+        futures = [future for _, future in batch]
+        try:
+            result = self.executor.submit(extract_metadata_batch, [start for start, _ in batch])
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+            return
+        def resolve(done):
+            try:
+                for future, exif_data in zip(futures, done.result()):
+                    future.set_result(exif_data)
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+        result.add_done_callback(resolve)
+
+    def shutdown(self):
+        """Send the pending starts and stop the worker processes."""
+        self.flush()
+        self.executor.shutdown(wait=True)
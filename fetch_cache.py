@@ -0,0 +1,145 @@
+"""
+Fetch-layer cache of the image fingerprints.
+Concurrent fetches of one image URL share a single request (SingleFlight).
+The etag, Last-Modified, size and fingerprint of each fetched image are kept in SQLite
+across runs, a re-crawl sends If-None-Match/If-Modified-Since and reuses the stored
+fingerprint on 304 Not Modified. The least recently used entries are evicted
+above the capacity, and the entries older than the TTL are dropped.
+"""
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+EVICT_EVERY = 1000 # Check the capacity after this many stored entries
+
+class SingleFlight:
+    """Run one call per key at a time, concurrent callers with the same key wait for its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> Future of the running call
+
+    def do(self, key, func, *args):
+        """Call func(*args), or wait for the running call with the same key."""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+class CacheEntry:
+    """Validators and fingerprint of a fetched image."""
+    __slots__ = ("etag", "last_modified", "image_size", "fields", "fetched_at")
+
+    def __init__(self, etag, last_modified, image_size, fields, fetched_at):
+        self.etag = etag # Raw ETag header
+        self.last_modified = last_modified # Raw Last-Modified header
+        self.image_size = image_size
+        self.fields = fields # exif, sha256_first_10240_bytes, random_128_bytes_sample_start if downloaded
+        self.fetched_at = fetched_at # Time of the last download or revalidation
+
+    def validators(self):
+        """Conditional request headers, {} if the server sent no validators."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def matches(self, headers):
+        """Check if the lowercase response headers validate the entry, like a 304 would."""
+        if self.etag or headers.get("etag"):
+            return self.etag == headers.get("etag")
+        return bool(self.last_modified) and self.last_modified == headers.get("last-modified")
+
+class FetchCache:
+    """Persistent URL -> (validators, size, fingerprint) cache, thread-safe."""
+
+    def __init__(self, store_path, capacity, ttl):
+        self.capacity = capacity # Entries
+        self.ttl = ttl # Seconds
+        self.lock = threading.Lock()
+        self.stored = 0
+        self.connection = sqlite3.connect(store_path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                image_size INTEGER NOT NULL,
+                fields TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS images_used_at ON images (used_at);
+        """)
+        with self.lock:
+            self.connection.execute("DELETE FROM images WHERE fetched_at < ?", (time.time() - self.ttl,))
+            self.connection.commit()
+
+    def get(self, url):
+        """Entry of a URL, None if there is none or it expired."""
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, image_size, fields, fetched_at FROM images WHERE url = ?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            if row[4] < now - self.ttl:
+                self.connection.execute("DELETE FROM images WHERE url = ?", (url,))
+                self.connection.commit()
+                return None
+            self.connection.execute("UPDATE images SET used_at = ? WHERE url = ?", (now, url))
+            self.connection.commit()
+        return CacheEntry(row[0], row[1], row[2], json.loads(row[3]), row[4])
+
+    def put(self, url, headers, image_size, fields):
+        """Store the fingerprint of a downloaded image with the validators of its lowercase headers."""
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images (url, etag, last_modified, image_size, fields, fetched_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, headers.get("etag"), headers.get("last-modified"), image_size,
+                 json.dumps(fields), now, now))
+            self.stored += 1
+            if self.stored % EVICT_EVERY == 0:
+                self.evict()
+            self.connection.commit()
+
+    def revalidated(self, url):
+        """The server confirmed the entry is still valid."""
+        with self.lock:
+            self.connection.execute("UPDATE images SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            self.connection.commit()
+
+    def evict(self):
+        """Remove the least recently used entries above the capacity, call with the lock held."""
+        count = self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        if count > self.capacity:
+            self.connection.execute(
+                "DELETE FROM images WHERE url IN (SELECT url FROM images ORDER BY used_at LIMIT ?)",
+                (count - self.capacity,))
+
+    def close(self):
+        """Evict the entries above the capacity and close the store."""
+        with self.lock:
+            self.evict()
+            self.connection.commit()
+            self.connection.close()
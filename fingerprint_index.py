@@ -0,0 +1,290 @@
+"""
+In-memory indexes for comparing image fingerprints.
+Only the fingerprints are kept in memory, in compact records,
+a match is reported by the URL and the file of the record.
+The 128-byte samples are matched against a new 10240-byte image start in one pass.
+The perceptual hashes of the EXIF thumbnails are searched within a Hamming distance.
+"""
+import itertools
+import numpy as np
+from perceptual_hash import hamming_distances
+
+MISSING = object() # The record has no etag field, unlike etag None
+SAMPLE_GRAM = 8 # Length of the indexed sample slices (q-grams)
+SAMPLE_STEP = 4 # The image start is probed at every SAMPLE_STEP bytes, SAMPLE_STEP q-grams per sample
+SAMPLE_SIZE = 128 # Length of random_128_bytes_sample_start, stored in fixed-width slots
+PHASH_CHUNKS = 4 # The 64-bit thumbnail hashes are indexed by 4 chunks of 16 bits
+CHUNK_BITS = 64 // PHASH_CHUNKS
+
+def is_padding_sample(sample_hex):
+    """Detect if the sample is empty padding, mostly zeros."""
+    return sample_hex.count("0") / len(sample_hex) >= 0.9
+
+def digest_key(sha256_hex):
+    """Fixed-width 32-byte key of a hex digest, other values are kept as they are."""
+    if isinstance(sha256_hex, str) and len(sha256_hex) == 64:
+        try:
+            return bytes.fromhex(sha256_hex)
+        except ValueError:
+            pass
+    return sha256_hex
+
+class Fingerprint:
+    """Compact record of a collected image, the position of the record in its JSON file."""
+    __slots__ = ("order", "file_path", "position", "url", "sha256", "etag")
+
+    def __init__(self, order, file_path, position, url, sha256, etag):
+        self.order = order # Position in the whole collection, matches are reported in this order
+        self.file_path = file_path
+        self.position = position
+        self.url = url
+        self.sha256 = sha256 # digest_key() of sha256_first_10240_bytes or None
+        self.etag = etag # MISSING if the record has no etag
+
+    def summary(self):
+        """The fingerprint fields as a metadata dict."""
+        summary = {"url": self.url}
+        if self.sha256 is not None:
+            summary["sha256_first_10240_bytes"] = (
+                self.sha256.hex() if isinstance(self.sha256, bytes) else self.sha256)
+        if self.etag is not MISSING:
+            summary["etag"] = self.etag
+        return summary
+
+class FingerprintIndex:
+    """
+    Hash maps from sha256 and etag to the fingerprints, the sample index and the thumbnail hash index.
+    Writers must be serialized by the caller. Readers do not need a lock,
+    the records and the buckets are only appended to.
+    """
+
+    def __init__(self, max_distance=10):
+        self.records = [] # Fingerprint in insertion order
+        self.sha256 = {} # digest_key -> [Fingerprint]
+        self.etags = {} # etag -> [Fingerprint]
+        self.samples = SampleIndex() # random_128_bytes_sample_start -> Fingerprint
+        self.thumbnails = HammingIndex(max_distance) # thumbnail_phash -> Fingerprint
+        self.order = itertools.count()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, file_path, position, url, sha256_hex=None, etag=MISSING, sample_hex=None, phash_hex=None):
+        """Index the fingerprint of one metadata record, the digest and the sample can also be bytes."""
+        sha256 = digest_key(sha256_hex) if sha256_hex is not None else None
+        fingerprint = Fingerprint(next(self.order), file_path, position, url, sha256, etag)
+        self.records.append(fingerprint)
+        if sha256 is not None:
+            self.sha256.setdefault(sha256, []).append(fingerprint)
+        if etag is not MISSING:
+            self.etags.setdefault(etag, []).append(fingerprint)
+        self.samples.add(sample_hex, fingerprint)
+        self.thumbnails.add(phash_hex, fingerprint)
+        return fingerprint
+
+    def add_metadata(self, file_path, position, metadata):
+        """Index the fingerprint of a metadata dict."""
+        return self.add(file_path, position, metadata.get("url"),
+                        metadata.get("sha256_first_10240_bytes"), metadata.get("etag", MISSING),
+                        metadata.get("random_128_bytes_sample_start"), metadata.get("thumbnail_phash"))
+
+    def by_sha256(self, sha256_hex):
+        """Fingerprints with the same sha256_first_10240_bytes."""
+        return list(self.sha256.get(digest_key(sha256_hex), ()))
+
+    def by_etag(self, etag):
+        """Fingerprints with the same etag."""
+        return list(self.etags.get(etag, ()))
+
+    def by_sample(self, start_bytes):
+        """Fingerprints whose 128-byte sample is within start_bytes."""
+        return self.samples.find(start_bytes)
+
+    def by_thumbnail(self, phash_hex):
+        """(fingerprint, distance) of the thumbnail hashes within the max distance."""
+        return self.thumbnails.find(phash_hex)
+
+    def snapshot(self):
+        """The fingerprints indexed so far."""
+        return self.records[:len(self.records)]
+
+class SampleIndex:
+    """
+    Multi-pattern index over the stored random_128_bytes_sample_start values.
+    Each sample is indexed by its q-grams at offsets 0..SAMPLE_STEP-1.
+    Any occurrence of a sample in the image start covers a probe position
+    (a multiple of SAMPLE_STEP) at one of those offsets,
+    so probing the image start every SAMPLE_STEP bytes finds every stored sample.
+    """
+
+    def __init__(self):
+        self.data = bytearray() # Samples of SAMPLE_SIZE bytes back to back, sample_id * SAMPLE_SIZE
+        self.entries = [] # sample_id -> entry
+        self.other_samples = {} # sample_id -> sample bytes of other lengths
+        # q-gram -> code or [codes], code = sample_id * SAMPLE_STEP + offset in the sample
+        # A single code is stored without a list, most q-grams are unique
+        self.grams = {}
+        self.short_samples = [] # sample_ids too short to be indexed by q-grams
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample(self, sample_id):
+        """Bytes of a stored sample."""
+        if sample_id in self.other_samples:
+            return self.other_samples[sample_id]
+        return bytes(self.data[sample_id * SAMPLE_SIZE:(sample_id + 1) * SAMPLE_SIZE])
+
+    def add(self, sample_hex, entry):
+        """Index a hex (or bytes) sample owned by entry, empty padding samples are ignored."""
+        if isinstance(sample_hex, bytes):
+            sample, sample_hex = sample_hex, sample_hex.hex()
+        else:
+            sample = None
+        if not sample_hex or is_padding_sample(sample_hex):
+            return False
+        if sample is None:
+            try:
+                sample = bytes.fromhex(sample_hex)
+            except ValueError:
+                return False
+        sample_id = len(self.entries)
+        if len(sample) == SAMPLE_SIZE:
+            self.data += sample
+        else: # Keep the slots aligned to sample_id
+            self.data += bytes(SAMPLE_SIZE)
+            self.other_samples[sample_id] = sample
+        self.entries.append(entry)
+        if len(sample) < SAMPLE_GRAM + SAMPLE_STEP - 1:
+            self.short_samples.append(sample_id)
+            return True
+        grams = self.grams
+        for offset in range(SAMPLE_STEP):
+            gram = sample[offset:offset + SAMPLE_GRAM]
+            code = sample_id * SAMPLE_STEP + offset
+            codes = grams.get(gram)
+            if codes is None:
+                grams[gram] = code
+            elif isinstance(codes, int):
+                grams[gram] = [codes, code]
+            else:
+                codes.append(code)
+        return True
+
+    def groups(self):
+        """Map of sample bytes -> entries, for the samples shared by more than one entry."""
+        groups = {}
+        for sample_id, entry in enumerate(self.entries):
+            groups.setdefault(self.sample(sample_id), []).append(entry)
+        return {sample: entries for sample, entries in groups.items() if len(entries) > 1}
+
+    def find(self, start_bytes):
+        """Return the entries whose sample is within start_bytes."""
+        found = set()
+        grams = self.grams
+        for probe in range(0, len(start_bytes) - SAMPLE_GRAM + 1, SAMPLE_STEP):
+            codes = grams.get(start_bytes[probe:probe + SAMPLE_GRAM])
+            if codes is None:
+                continue
+            for code in (codes,) if isinstance(codes, int) else codes:
+                sample_id, offset = divmod(code, SAMPLE_STEP)
+                if sample_id in found:
+                    continue
+                start = probe - offset
+                sample = self.sample(sample_id)
+                if start >= 0 and start_bytes[start:start + len(sample)] == sample:
+                    found.add(sample_id)
+        for sample_id in self.short_samples:
+            if self.sample(sample_id) in start_bytes:
+                found.add(sample_id)
+        return [self.entries[sample_id] for sample_id in found]
+
+class HammingIndex:
+    """
+    Multi-index hashing of the 64-bit thumbnail hashes.
+    Each hash is indexed under each of its PHASH_CHUNKS chunks.
+    Two hashes within max_distance bits differ by at most max_distance // PHASH_CHUNKS bits
+    in one of their chunks, so a search probes only the chunk values within that radius
+    and checks the full distance of all candidates at once.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        # hash_id -> hash, grown by doubling, readers keep using the array they got
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.entries = [] # hash_id -> entry
+        # Chunk value -> hash_id or [hash_ids], per chunk, most chunk values are unique
+        self.tables = [{} for _ in range(PHASH_CHUNKS)]
+        radius = max_distance // PHASH_CHUNKS
+        self.flips = [0] # Masks of at most radius bits of a chunk
+        for _ in range(radius):
+            self.flips = sorted({flip | 1 << bit for flip in self.flips for bit in range(CHUNK_BITS)}
+                                | set(self.flips))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def parse(phash_hex):
+        """Hash int of a hex value, None if it is not a 64-bit hex hash."""
+        if not isinstance(phash_hex, str) or len(phash_hex) != 16:
+            return None
+        try:
+            return int(phash_hex, 16)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def chunks(value):
+        """The chunk values of a hash."""
+        mask = (1 << CHUNK_BITS) - 1
+        return [(value >> (chunk * CHUNK_BITS)) & mask for chunk in range(PHASH_CHUNKS)]
+
+    def add(self, phash_hex, entry):
+        """Index a hex hash owned by entry."""
+        value = self.parse(phash_hex)
+        if value is None:
+            return False
+        hash_id = len(self.entries)
+        if hash_id == len(self.hashes):
+            hashes = np.zeros(2 * hash_id, dtype=np.uint64)
+            hashes[:hash_id] = self.hashes
+            self.hashes = hashes
+        self.hashes[hash_id] = value
+        self.entries.append(entry) # The hash is set before the entry is visible
+        for table, chunk in zip(self.tables, self.chunks(value)):
+            ids = table.get(chunk)
+            if ids is None:
+                table[chunk] = hash_id
+            elif isinstance(ids, int):
+                table[chunk] = [ids, hash_id]
+            else:
+                ids.append(hash_id)
+        return True
+
+    def find(self, phash_hex):
+        """(entry, distance) of the hashes within max_distance bits of a hex hash."""
+        value = self.parse(phash_hex)
+        if value is None:
+            return []
+        count = len(self.entries) # Hashes indexed before the search
+        hashes = self.hashes
+        candidates = []
+        for table, chunk in zip(self.tables, self.chunks(value)):
+            for flip in self.flips:
+                ids = table.get(chunk ^ flip)
+                if ids is None:
+                    continue
+                if isinstance(ids, int):
+                    candidates.append(ids)
+                else:
+                    candidates.extend(ids)
+        if not candidates:
+            return []
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        candidates = candidates[candidates < count]
+        distances = hamming_distances(hashes[candidates], value)
+        close = distances <= self.max_distance
+        # A candidate found by several chunks is checked several times, only the close ones are merged
+        found = dict(zip(candidates[close].tolist(), distances[close].tolist()))
+        return [(self.entries[hash_id], distance) for hash_id, distance in sorted(found.items())]
@@ -0,0 +1,171 @@
+"""
+Persistent SQLite store of the metadata JSON files.
+The modification time and the size of each JSON file are recorded,
+so only new or changed files are parsed at startup.
+The store can be rebuilt from the JSON files at any time:
+python fingerprint_store.py
+"""
+import os
+import json
+import sqlite3
+import multiprocessing
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from exif_metadata import START_METHOD
+import settings # Import the settings from settings.py
+
+SCHEMA_VERSION = 4 # Stores with another version are rebuilt
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT,
+    sha256 TEXT,
+    etag TEXT,
+    has_etag INTEGER NOT NULL,
+    sample TEXT,
+    phash TEXT,
+    PRIMARY KEY (path, position)
+);
+"""
+
+def metadata_file_paths():
+    """All JSON metadata files of the data folder and the archives."""
+    metadata_files = glob(f"{settings.DATA_FOLDER}*/*.json")
+    for archive_dir in settings.ARCHIVE:
+        metadata_files.extend(glob(f"{archive_dir}*/*.json"))
+    return metadata_files
+
+def connect(store_path):
+    """Open the store and create the tables, an old version of the store is dropped."""
+    connection = sqlite3.connect(store_path)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS records;")
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    connection.executescript(SCHEMA)
+    return connection
+
+def file_signature(file_path):
+    """(mtime_ns, size) of a file."""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+def fingerprint_rows(metadata_list):
+    """(position, url, sha256, has_etag, etag, sample, phash) rows of the metadata records."""
+    return [(position, metadata.get("url"), metadata.get("sha256_first_10240_bytes"), "etag" in metadata,
+             metadata.get("etag"), metadata.get("random_128_bytes_sample_start"), metadata.get("thumbnail_phash"))
+            for position, metadata in enumerate(metadata_list)]
+
+def read_json_file(file_path):
+    """Parse a metadata JSON file, a single record is returned as a list."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return [data] if isinstance(data, dict) else data
+
+def parse_file(file_path):
+    """
+    Parse a JSON file into fingerprint rows, run in a worker process.
+    Returns (file_path, (mtime_ns, size), rows, error).
+    """
+    try:
+        signature = file_signature(file_path)
+        return file_path, signature, fingerprint_rows(read_json_file(file_path)), None
+    except Exception as error:
+        return file_path, None, None, error
+
+def parse_files(file_paths, processes=None):
+    """
+    Parse the JSON files in settings.LOAD_PROCESSES worker processes, yields in the given order.
+    The workers start with exif_metadata.START_METHOD, the crawler loads from a crawl thread.
+    """
+    processes = processes or settings.LOAD_PROCESSES
+    if processes <= 1 or len(file_paths) < 2:
+        for file_path in file_paths:
+            yield parse_file(file_path)
+        return
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+        yield from executor.map(parse_file, file_paths, chunksize=256)
+
+def store_file(connection, file_path, signature, rows):
+    """Replace the records of a JSON file."""
+    connection.execute("DELETE FROM records WHERE path = ?", (file_path,))
+    connection.executemany(
+        "INSERT INTO records (path, position, url, sha256, has_etag, etag, sample, phash) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(file_path,) + row for row in rows])
+    connection.execute("INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                       (file_path, signature[0], signature[1]))
+
+def update_store(connection, file_paths):
+    """
+    Parse the new and changed JSON files into the store and remove the deleted files.
+    Returns the number of parsed files.
+    """
+    known = {path: (mtime_ns, size) for path, mtime_ns, size
+             in connection.execute("SELECT path, mtime_ns, size FROM files")}
+    changed = []
+    for file_path in file_paths:
+        try:
+            if known.pop(file_path, None) == file_signature(file_path):
+                continue # Unchanged
+        except OSError:
+            pass
+        changed.append(file_path)
+    parsed = 0
+    for file_path, signature, rows, error in parse_files(changed):
+        if error is not None:
+            print(f"Failed to load {file_path}: {error}", flush=True)
+            continue
+        store_file(connection, file_path, signature, rows)
+        parsed += 1
+    for file_path in known: # Deleted files
+        connection.execute("DELETE FROM records WHERE path = ?", (file_path,))
+        connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+    connection.commit()
+    return parsed
+
+def load_fingerprints(file_paths, store_path):
+    """
+    Load the fingerprints of the JSON files through the store.
+    Returns a list of (file_path, [(position, url, sha256, has_etag, etag, sample, phash)])
+    in the order of file_paths.
+    """
+    connection = connect(store_path)
+    try:
+        parsed = update_store(connection, file_paths)
+        print(f"Parsed {parsed} new or changed metadata files into {store_path}.", flush=True)
+        records = {}
+        for row in connection.execute(
+                "SELECT path, position, url, sha256, has_etag, etag, sample, phash FROM records "
+                "ORDER BY path, position"):
+            records.setdefault(row[0], []).append(row[1:])
+        return [(file_path, records[file_path]) for file_path in file_paths if file_path in records]
+    finally:
+        connection.close()
+
+def rebuild(store_path):
+    """Rebuild the store from the JSON files."""
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    connection = connect(store_path)
+    try:
+        parsed = update_store(connection, metadata_file_paths())
+    finally:
+        connection.close()
+    print(f"Rebuilt {store_path} from {parsed} metadata files.", flush=True)
+
+def main():
+    """ Main """
+    if not settings.FINGERPRINT_STORE:
+        print("FINGERPRINT_STORE is not set in settings.py", flush=True)
+        return
+    rebuild(settings.FINGERPRINT_STORE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Incremental extraction of the image URLs of an HTML page.
+The page is parsed while it is downloaded, the download stops as soon as
+enough image URLs are found, no document tree is built.
+Besides <img src>, the srcset candidates, <picture><source>, lazy-load data-src
+attributes and CSS background images are picked up.
+An <img> counts as one image: its lazy-load URL if it has one, else its src, else
+the largest srcset candidate, and a <picture> counts as one image: its <img>, else
+its first <source>.
+"""
+import re
+import codecs
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+# (src, srcset) attribute pairs of an image, in order of preference
+# The lazy-load attributes hold the real image URL, the src is often a placeholder
+IMAGE_ATTRIBUTES = (("data-src", "data-srcset"), ("data-lazy-src", "data-lazy-srcset"), ("data-original", None),
+                    ("src", "srcset"))
+# url(...) of a CSS background or background-image declaration
+CSS_BACKGROUND_URL = re.compile(
+    r"background(?:-image)?\s*:[^;{}]*?url\(\s*(['\"]?)(.*?)\1\s*\)", re.IGNORECASE)
+
+def charset_from_content_type(content_type, default="utf-8"):
+    """Charset of a Content-Type header, default if there is none or it is unknown."""
+    for parameter in content_type.split(";")[1:]:
+        name, _, value = parameter.partition("=")
+        if name.strip().lower() == "charset":
+            try:
+                return codecs.lookup(value.strip().strip('"\'')).name
+            except LookupError:
+                break
+    return default
+
+def srcset_candidates(srcset):
+    """
+    (url, descriptor) candidates of a srcset attribute: "url [descriptor], ...".
+    A URL ends at a whitespace, like the HTML parsing rules, so it can contain commas.
+    """
+    candidates = []
+    position = 0
+    length = len(srcset)
+    while True:
+        while position < length and (srcset[position].isspace() or srcset[position] == ","):
+            position += 1
+        if position >= length:
+            return candidates
+        end = position
+        while end < length and not srcset[end].isspace():
+            end += 1
+        url = srcset[position:end]
+        if url.endswith(","): # No descriptor
+            candidates.append((url.rstrip(","), ""))
+            position = end
+            continue
+        comma = srcset.find(",", end)
+        comma = length if comma == -1 else comma
+        candidates.append((url, srcset[end:comma].strip()))
+        position = comma + 1
+
+def candidate_size(descriptor):
+    """Sort key of a srcset descriptor, the widths ("800w") rank above the densities ("2x", 1x by default)."""
+    try:
+        if descriptor.endswith("w"):
+            return 1, float(descriptor[:-1])
+        if descriptor.endswith("x"):
+            return 0, float(descriptor[:-1])
+    except ValueError:
+        pass
+    return 0, 1.0
+
+def largest_candidate(srcset):
+    """URL of the largest candidate of a srcset attribute, None if it is empty."""
+    candidates = srcset_candidates(srcset)
+    if not candidates:
+        return None
+    return max(candidates, key=lambda candidate: candidate_size(candidate[1]))[0]
+
+class ImageLinkExtractor(HTMLParser):
+    """
+    Feed the page bytes as they arrive, the resolved image URLs are collected
+    in document order without duplicates, up to max_urls.
+    """
+
+    def __init__(self, base_url, max_urls, encoding="utf-8"):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.max_urls = max_urls
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.urls = [] # Resolved image URLs in document order
+        self.seen = set()
+        self.in_style = False # Inside a <style> element
+        self.picture = None # Attributes of the first <source> of the current <picture>, [] if there is none
+        self.picture_found = False # The <img> of the current <picture> has an image URL
+        self.bytes_read = 0
+
+    @property
+    def full(self):
+        """Enough image URLs are found."""
+        return len(self.urls) >= self.max_urls
+
+    def feed_bytes(self, chunk):
+        """Parse the next chunk of the page, returns True when enough image URLs are found."""
+        self.bytes_read += len(chunk)
+        self.feed(self.decoder.decode(chunk))
+        return self.full
+
+    def close(self):
+        """Parse the rest of the page."""
+        self.feed(self.decoder.decode(b"", final=True))
+        super().close()
+
+    def add_url(self, url):
+        """
+        Resolve and collect an image URL, data: and non-HTTP URLs are skipped.
+        Returns True if it is an HTTP image URL, collected now or before.
+        """
+        if not url:
+            return False
+        url = urljoin(self.base_url, url.strip())
+        if urlparse(url).scheme not in ("http", "https"):
+            return False
+        if not self.full and url not in self.seen:
+            self.seen.add(url)
+            self.urls.append(url)
+        return True
+
+    def add_image(self, tag, attributes):
+        """Collect the image URL of an <img> or <source>, returns True if it has one."""
+        for src_name, srcset_name in IMAGE_ATTRIBUTES:
+            src = attributes.get(src_name) if tag == "img" or src_name != "src" else None
+            if self.add_url(src):
+                return True
+            if srcset_name and self.add_url(largest_candidate(attributes.get(srcset_name, ""))):
+                return True
+        return False
+
+    def add_css_urls(self, css):
+        """Collect the background image URLs of a style sheet or a style attribute."""
+        for match in CSS_BACKGROUND_URL.finditer(css):
+            self.add_url(match.group(2))
+
+    def handle_starttag(self, tag, attrs):
+        attributes = {name: value for name, value in attrs if value}
+        if tag == "base" and "href" in attributes: # Later relative URLs resolve against it
+            self.base_url = urljoin(self.base_url, attributes["href"])
+        elif tag == "style":
+            self.in_style = True
+        if tag == "picture":
+            self.picture = []
+            self.picture_found = False
+        elif tag == "source" and self.picture is not None: # Alternative of the <img> of the <picture>
+            if not self.picture:
+                self.picture = attributes
+        elif tag == "img" and self.picture is not None:
+            self.picture_found = self.add_image(tag, attributes) or self.picture_found
+        elif tag in ("img", "source"):
+            self.add_image(tag, attributes)
+        if "style" in attributes:
+            self.add_css_urls(attributes["style"])
+
+    def handle_endtag(self, tag):
+        if tag == "style":
+            self.in_style = False
+        elif tag == "picture" and self.picture is not None:
+            if not self.picture_found and self.picture:
+                self.add_image("source", self.picture)
+            self.picture = None
+
+    def handle_data(self, data):
+        if self.in_style:
+            self.add_css_urls(data)
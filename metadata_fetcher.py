@@ -6,126 +6,332 @@ Ignore small images.
 """
 import io
 import os
+import gc
 import json
-from hashlib import sha256, blake2b
+from hashlib import sha256
+import time
 import datetime
 import threading
 from urllib.parse import urljoin, urlparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, as_completed, wait, FIRST_COMPLETED
 from glob import glob
+from contextlib import contextmanager
 import requests
-import piexif
-import exifread
+import socks
 from PIL import Image
-from PIL.ExifTags import TAGS
-from bs4 import BeautifulSoup
+from exif_metadata import extract_metadata, jpeg_metadata_end, ExifBatcher
+from perceptual_hash import thumbnail_phash
+from image_links import ImageLinkExtractor, charset_from_content_type
+from fingerprint_index import FingerprintIndex, MISSING
+import fingerprint_store
+import result_segments
+from result_segments import SegmentWriter
+from session_pool import SessionPool
+from proxy_pool import ProxyPool, error_chain
+from scheduler import DomainScheduler, DomainQuota, PAGE, IMAGE
+from fetch_cache import FetchCache, SingleFlight
+from url_index import ScannedUrlIndex, UrlFeed
+import metrics
 import settings # Import the settings from settings.py
 
-METADATA_CACHE = {} # Global cache of metadata from JSON files
-METADATA_LOCK = threading.Lock()
+FINGERPRINT_END = 10240 # The fingerprint is taken from the range bytes=0-10240 (inclusive)
+FINGERPRINT_SIZE = FINGERPRINT_END + 1
+# Metadata fields reused from the fetch cache when the image did not change
+CACHED_FIELDS = ("exif", "sha256_first_10240_bytes", "random_128_bytes_sample_start", "thumbnail_phash")
+
+FINGERPRINTS = FingerprintIndex(settings.THUMBNAIL_MAX_DISTANCE) # Global index of the collected image fingerprints
+METADATA_KEYS = set() # Loaded JSON file paths and URLs of the new images
+METADATA_LOCK = threading.Lock() # Serializes the writers, the readers do not lock
+METADATA_LOADED = False # The JSON files are loaded only once
+EXIF_BATCHER = None # Process pool for the EXIF extraction, created on first use
+EXIF_BATCHER_LOCK = threading.Lock()
+SCANNED_URLS = None # Index of the scanned URLs, opened by open_scanned_urls()
+SEGMENT_WRITER = None # Writer of the result segments, opened on first use
+SEGMENT_WRITER_LOCK = threading.Lock()
+FETCH_CACHE = None # Cross-run cache of the image fingerprints, opened on first use
+FETCH_CACHE_LOCK = threading.Lock()
+IMAGE_FETCHES = SingleFlight() # Concurrent fetches of the same image URL share one download
+# Keep-alive sessions per host and proxy
+SESSION_POOL = SessionPool(settings.SESSION_POOL_SIZE, settings.SESSION_IDLE_TIMEOUT)
+# Health of the Tor proxies and the onion domain affinity
+PROXY_POOL = ProxyPool(settings.PROXIES, settings.PROXY_MAX_IN_FLIGHT, settings.PROXY_MAX_FAILURES,
+                       settings.PROXY_EJECT_SECONDS, settings.PROXY_SLOW_FACTOR)
+
+def add_metadata(file_path, metadata_list):
+    """Add the fingerprints of metadata records to the index, call with METADATA_LOCK held."""
+    METADATA_KEYS.add(file_path)
+    for position, metadata in enumerate(metadata_list):
+        FINGERPRINTS.add_metadata(file_path, position, metadata)
+
+def load_metadata_files():
+    """Read the fingerprints of all JSON metadata files, call with METADATA_LOCK held."""
+    global METADATA_LOADED
+    if METADATA_LOADED:
+        return
+    metadata_files = fingerprint_store.metadata_file_paths()
+    gc.disable() # Millions of new objects, the cyclic garbage collector would rescan them all
+    try:
+        if settings.FINGERPRINT_STORE: # Parse only the new and changed files
+            loaded = fingerprint_store.load_fingerprints(metadata_files, settings.FINGERPRINT_STORE)
+        else: # Parse all files, in settings.LOAD_PROCESSES worker processes
+            loaded = []
+            for json_file_path, _, rows, error in fingerprint_store.parse_files(metadata_files):
+                if error is not None:
+                    print(f"Failed to load {json_file_path}: {error}", flush=True)
+                    continue
+                loaded.append((json_file_path, rows))
+        for json_file_path, rows in loaded:
+            METADATA_KEYS.add(json_file_path)
+            for position, url, sha256_hex, has_etag, etag, sample_hex, phash_hex in rows:
+                FINGERPRINTS.add(json_file_path, position, url, sha256_hex,
+                                 etag if has_etag else MISSING, sample_hex, phash_hex)
+        # Result segments, scanned directly
+        for record_location, _, images in result_segments.iter_records(result_segments.all_segment_paths()):
+            METADATA_KEYS.add(record_location)
+            for position, (url, sha256_digest, has_etag, etag, sample, phash_hex, _) in enumerate(images):
+                FINGERPRINTS.add(record_location, position, url, sha256_digest,
+                                 etag if has_etag else MISSING, sample, phash_hex)
+    finally:
+        gc.enable()
+    print(f"Loaded {len(METADATA_KEYS)} metadata files into cache.", flush=True)
+    METADATA_LOADED = True
+
+def ensure_loaded(new_metadata=None):
+    """Load all JSON metadata files only once into the global index, and index a new image."""
+    with metrics.timer("metadata_lock_wait"):
+        METADATA_LOCK.acquire()
+    try:
+        if not METADATA_LOADED:
+            with metrics.timer("load_metadata"):
+                load_metadata_files()
+        if new_metadata and not new_metadata["url"] in METADATA_KEYS:
+            add_metadata(new_metadata["url"], [new_metadata])
+    finally:
+        METADATA_LOCK.release()
 
 def load_all_metadata(new_metadata=None):
-    """Load all JSON metadata files only once into the global cache."""
-    global METADATA_CACHE
-    # Always protect cache operations with the lock
-    with METADATA_LOCK: # Lock
-        if METADATA_CACHE:
-            if new_metadata and not new_metadata["url"] in METADATA_CACHE:
-                METADATA_CACHE[new_metadata["url"]] = [new_metadata]
-            return METADATA_CACHE.copy()
-        # Else, download from the folder
-        metadata_files = glob(f"{settings.DATA_FOLDER}*/*.json")
-        for archive_dir in settings.ARCHIVE:
-            metadata_files.extend(glob(f"{archive_dir}*/*.json"))
-        for json_file_path in metadata_files:
-            try:
-                with open(json_file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    METADATA_CACHE[json_file_path] = data
-            except Exception as error:
-                print(f"Failed to load {json_file_path}: {error}", flush=True)
-        print(f"Loaded {len(METADATA_CACHE)} metadata files into cache.", flush=True)
-        if new_metadata and not new_metadata["url"] in METADATA_CACHE:
-            METADATA_CACHE[new_metadata["url"]] = [new_metadata]
-        # Return a shallow copy so other threads can iterate safely
-        return METADATA_CACHE.copy()
+    """
+    Load all JSON metadata files only once into the global index.
+    Returns a snapshot list of the indexed fingerprints, see fingerprint_index.Fingerprint.
+    """
+    ensure_loaded(new_metadata)
+    return FINGERPRINTS.snapshot()
+
+def find_matches(new_metadata, start_bytes=None):
+    """
+    Look up the collected images matching a new image.
+    Returns (fingerprint, hash_match, etag_match, sample_match, thumbnail_distance) tuples
+    in the collection order, thumbnail_distance is None if the thumbnail hashes are not close
+    or the image already matched by hash, etag or sample.
+    """
+    ensure_loaded(new_metadata)
+    # Lock-free lookups, the index is only appended to
+    matches = {} # order -> [fingerprint, hash_match, etag_match, sample_match, thumbnail_distance]
+    if "sha256_first_10240_bytes" in new_metadata:
+        for fingerprint in FINGERPRINTS.by_sha256(new_metadata["sha256_first_10240_bytes"]):
+            matches.setdefault(fingerprint.order, [fingerprint, False, False, False, None])[1] = True
+    if "etag" in new_metadata:
+        for fingerprint in FINGERPRINTS.by_etag(new_metadata["etag"]):
+            matches.setdefault(fingerprint.order, [fingerprint, False, False, False, None])[2] = True
+    if start_bytes: # Check if the 128-byte samples are within the new image's start
+        for fingerprint in FINGERPRINTS.by_sample(start_bytes):
+            matches.setdefault(fingerprint.order, [fingerprint, False, False, False, None])[3] = True
+    if new_metadata.get("thumbnail_phash"): # Near-duplicates
+        for fingerprint, distance in FINGERPRINTS.by_thumbnail(new_metadata["thumbnail_phash"]):
+            match = matches.setdefault(fingerprint.order, [fingerprint, False, False, False, None])
+            if not any(match[1:4]): # An exact duplicate has the same thumbnail too
+                match[4] = distance
+    new_url = new_metadata.get("url")
+    return [tuple(matches[order]) for order in sorted(matches)
+            if matches[order][0].url != new_url] # Do not compare the same images!
 
+@metrics.timed("compare")
 def compare_images(new_metadata, start_bytes=None):
     """ Compare a new image to the collected images """
-    # Compare new metadata with the collected metadata, read all JSON files
-    all_metadata = load_all_metadata(new_metadata)
+    new_url = new_metadata.get("url")
     url_printed = False
-    for file_path, metadata_list in all_metadata.items():
-        for metadata in metadata_list:
-            # Check if the URL matches
-            new_url = new_metadata.get("url")
-            if metadata.get("url") == new_url:
-                continue # Same URL, same image, do not compare the same images!
-            # Compare SHA256 sums
-            if metadata.get("sha256_first_10240_bytes", 1) == new_metadata.get("sha256_first_10240_bytes", 2):
-                if not url_printed:
-                    print(f"\n{'-'*120}", flush=True)
-                    print(f"Found match for the new image:\n{new_url}\n", flush=True)
-                    url_printed = True
-                print(f"Duplicate image based on the hash:\n\t{metadata['url']}  -->  {file_path}", flush=True)
-            # Compare etags
-            if metadata.get("etag", 1) == new_metadata.get("etag", 2):
-                if not url_printed:
-                    print(f"\n{'-'*120}", flush=True)
-                    print(f"Found match for the new image:\n{new_url}\n", flush=True)
-                    url_printed = True
-                print(f"Duplicate image detected based on etag:\n\t{metadata['url']}  -->  {file_path}", flush=True)
-            # Check if the 128-byte sample is within the new image's start
-            random_128 = metadata.get("random_128_bytes_sample_start", "")
-            if start_bytes and random_128:
-                # Detect if the existing sample is empty padding, mostly zeros
-                zero_ratio = random_128.count("0") / len(random_128)
-                if zero_ratio < 0.9: # it is not mostly zeros (more than 90% non-zeros)
-                    existing_start_sample = bytes.fromhex(random_128)
-                    if existing_start_sample in start_bytes:
-                        if not url_printed:
-                            print(f"\n{'-'*120}", flush=True)
-                            print(f"Found match for the new image:\n{new_url}\n", flush=True)
-                            url_printed = True
-                        print(f"128-byte sample matches:\n\t{metadata['url']}  -->  {file_path}", flush=True)
+    matches = find_matches(new_metadata, start_bytes)
+    for fingerprint, hash_match, etag_match, sample_match, thumbnail_distance in matches:
+        if not url_printed:
+            print(f"\n{'-'*120}", flush=True)
+            print(f"Found match for the new image:\n{new_url}\n", flush=True)
+            url_printed = True
+        file_path = fingerprint.file_path
+        if hash_match:
+            print(f"Duplicate image based on the hash:\n\t{fingerprint.url}  -->  {file_path}", flush=True)
+        if etag_match:
+            print(f"Duplicate image detected based on etag:\n\t{fingerprint.url}  -->  {file_path}", flush=True)
+        if sample_match:
+            print(f"128-byte sample matches:\n\t{fingerprint.url}  -->  {file_path}", flush=True)
+        if thumbnail_distance is not None:
+            print(f"Near-duplicate image based on the EXIF thumbnail ({thumbnail_distance} bits differ):"
+                  f"\n\t{fingerprint.url}  -->  {file_path}", flush=True)
     if url_printed:
         print(f"{'-'*120}", flush=True)
 
-def get_session_for_url(url):
+def duplicate_groups():
     """
-    Returns a requests session configured for the given URL.
-    If the URL is an onion address, the session will use the Tor proxy.
+    Cluster the collected images linked by hash, etag or 128-byte sample in one pass over the index.
+    The records sharing a key are joined (union-find), so each cluster is yielded once
+    as (reasons, fingerprints) if it has more than one image URL.
+    Records without an etag (None) are not linked by the etag.
     """
+    ensure_loaded()
+    parents = {} # order -> parent order
+    def find(order):
+        root = order
+        while parents.setdefault(root, root) != root:
+            root = parents[root]
+        while parents[order] != root: # Path compression
+            parents[order], order = root, parents[order]
+        return root
+    fingerprints_by_order = {}
+    links = [] # (reason, root order of one of the linked records)
+    keys = (
+        ("hash", FINGERPRINTS.sha256),
+        ("etag", {etag: group for etag, group in FINGERPRINTS.etags.items() if etag}),
+        ("128-byte sample", FINGERPRINTS.samples.groups()),
+    )
+    for reason, buckets in keys:
+        for fingerprints in buckets.values():
+            if len(fingerprints) < 2:
+                continue
+            first = find(fingerprints[0].order)
+            for fingerprint in fingerprints:
+                fingerprints_by_order[fingerprint.order] = fingerprint
+                root = find(fingerprint.order)
+                if root != first:
+                    parents[root] = first
+            if len({fingerprint.url for fingerprint in fingerprints}) > 1:
+                links.append((reason, first))
+    clusters = {} # root order -> [fingerprints]
+    for order in sorted(fingerprints_by_order):
+        clusters.setdefault(find(order), []).append(fingerprints_by_order[order])
+    reasons = {} # root order -> reasons in the order of keys
+    for reason, order in links:
+        cluster_reasons = reasons.setdefault(find(order), [])
+        if reason not in cluster_reasons:
+            cluster_reasons.append(reason)
+    for root, fingerprints in sorted(clusters.items(), key=lambda item: item[1][0].order):
+        if len({fingerprint.url for fingerprint in fingerprints}) > 1:
+            yield reasons.get(root, []), fingerprints
+
+def report_duplicates():
+    """Print each cluster of duplicate images in the collected data once."""
+    group_count = 0
+    for reasons, fingerprints in duplicate_groups():
+        print(f"\n{'-'*120}", flush=True)
+        print(f"Duplicate images based on the {', '.join(reasons)}:\n", flush=True)
+        for fingerprint in fingerprints:
+            print(f"\t{fingerprint.url}  -->  {fingerprint.file_path}", flush=True)
+        print(f"{'-'*120}", flush=True)
+        group_count += 1
+    print(f"Found {group_count} groups of duplicate images.", flush=True)
+
+def proxy_index_for_url(url):
+    """
+    Returns the index of the proxy in settings.PROXIES for the URL.
+    Returns None if the URL is not an onion address.
+    """
+    domain = urlparse(url).netloc.lower()
+    if not domain.endswith(".onion"):
+        return None
+    # Always select the same proxy for the same onion domain
+    # This will keep only one underlining Tor circuit to the onion service
+    # Rendezvous hashing keeps the affinity when proxies are added or removed,
+    # the domains of an ejected proxy fail over to their next proxy
+    return PROXY_POOL.select(domain)
+
+def new_session(proxy_index):
+    """Returns a requests session through the proxy of the index, direct if it is None."""
     session = requests.Session()
     ua = getattr(settings, "USER_AGENT", None)
     if ua:
         session.headers.setdefault("User-Agent", ua)
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc.lower()
-    if domain.endswith(".onion"):
-        # Always select the same proxy for the same onion domain
-        # This will keep only one underlining Tor circuit to the onion service
-        # Onion addresses form an uniform distribution
-        # Deterministic, side-effect-free selection
-        h = blake2b(domain.encode('utf-8'), digest_size=8).digest()
-        index = int.from_bytes(h, 'big') % len(settings.PROXIES)
-        # Always select the same proxy for the same onion address
-        session.proxies = settings.PROXIES[index]
+    if proxy_index is not None:
+        session.proxies = settings.PROXIES[proxy_index]
     return session
 
-def download_image_metadata(resource_url):
-    """Fetch image metadata."""
+def get_session_for_url(url):
+    """
+    Returns a requests session configured for the given URL.
+    If the URL is an onion address, the session will use the Tor proxy.
+    """
+    return new_session(proxy_index_for_url(url))
+
+def is_proxy_failure(error):
+    """The proxy itself is unreachable or broken, not only the site behind it."""
+    return any(isinstance(wrapped, (socks.ProxyConnectionError, requests.exceptions.ProxyError))
+               for wrapped in error_chain(error))
+
+@contextmanager
+def pooled_session(url, stage):
+    """
+    Borrow a keep-alive session from the pool for the given URL.
+    The sessions are shared by the URLs with the same host and proxy.
+    A request through a proxy holds one of its in-flight slots, its outcome is recorded.
+    The request is timed as the stage in the metrics.
+    """
+    parsed_url = urlparse(url)
+    index = proxy_index_for_url(url)
+    key = (parsed_url.scheme, parsed_url.netloc.lower(), index)
+    if index is None:
+        with SESSION_POOL.session(key, lambda: new_session(None)) as session:
+            with metrics.timer(stage, key[1]):
+                yield session
+        return
+    with PROXY_POOL.use(index, is_proxy_failure), SESSION_POOL.session(key, lambda: new_session(index)) as session:
+        with metrics.timer(stage, key[1], PROXY_POOL.keys[index]):
+            yield session
+
+def failover(url, request):
+    """
+    Call request(), which sends a request to the URL with pooled_session().
+    If the proxy itself fails, the request is sent again, up to settings.PROXY_RETRIES times,
+    through the next proxy of the domain once the failed proxy is ejected.
+    """
+    for _ in range(settings.PROXY_RETRIES):
+        try:
+            return request()
+        except Exception as error:
+            if proxy_index_for_url(url) is None or not is_proxy_failure(error):
+                raise
+    return request()
+
+def page_images(resource_url):
+    """
+    The images of a URL: ([resource_url], headers) for an image link,
+    (image URLs, None) for an HTML page, None for other resources.
+    """
     test_head = head(resource_url)
     if "image" in test_head.get("content-type", ""): # Image link
-        fetch_images([resource_url], resource_url, test_head)
-    elif settings.HTML_PARSING and "html" in test_head.get("content-type", ""): # HTML page
-        session = get_session_for_url(resource_url)
-        response = session.get(resource_url, allow_redirects=True, timeout=60)
-        if response.status_code != 200:
-            raise Exception(f"Failed to fetch URL: {resource_url}")
-        soup = BeautifulSoup(response.content, "html.parser")
-        img_tags = soup.find_all("img")
-        fetch_images(img_tags, resource_url)
+        return [resource_url], test_head
+    if settings.HTML_PARSING and "html" in test_head.get("content-type", ""): # HTML page
+        return page_image_urls(resource_url), None
+    return None
+
+def page_image_urls(resource_url):
+    """
+    Image URLs of an HTML page, parsed while the page is downloaded.
+    The download stops after MAX_IMG_PER_DOMAIN unique image URLs or HTML_MAX_BYTES bytes.
+    """
+    def get():
+        with pooled_session(resource_url, "page_get") as session:
+            response = session.get(resource_url, stream=True, allow_redirects=True, timeout=60)
+            with response: # Closes the connection if the page is not read to the end
+                if response.status_code != 200:
+                    raise Exception(f"Failed to fetch URL: {resource_url}")
+                extractor = ImageLinkExtractor(
+                    resource_url, settings.MAX_IMG_PER_DOMAIN,
+                    charset_from_content_type(response.headers.get("content-type", "")))
+                for chunk in response.iter_content(chunk_size=16384):
+                    if extractor.feed_bytes(chunk) or extractor.bytes_read >= settings.HTML_MAX_BYTES:
+                        break
+                else:
+                    extractor.close()
+                metrics.count("page_bytes", extractor.bytes_read, url_domain(resource_url))
+        return extractor.urls
+    return failover(resource_url, get)
 
 def file_path_from_url(url):
     """File path from the URL adddress"""
@@ -136,61 +342,120 @@ def file_path_from_url(url):
     filename = sha256(url.encode("utf-8")).hexdigest()[0:10]
     return folder, filename
 
+def segment_writer():
+    """The writer of the result segments of the data folder."""
+    global SEGMENT_WRITER
+    with SEGMENT_WRITER_LOCK:
+        if SEGMENT_WRITER is None:
+            SEGMENT_WRITER = SegmentWriter(result_segments.segments_folder(settings.DATA_FOLDER),
+                                           settings.SEGMENT_MAX_BYTES)
+    return SEGMENT_WRITER
+
+def close_segment_writer():
+    """Close the writer of the result segments."""
+    global SEGMENT_WRITER
+    with SEGMENT_WRITER_LOCK:
+        writer, SEGMENT_WRITER = SEGMENT_WRITER, None
+    if writer is not None:
+        writer.close()
+
+@metrics.timed("save")
 def save_results(results, url):
-    """Save results to JSON."""
+    """Save results to JSON, or to the result segments."""
+    folder, filename = file_path_from_url(url)
+    if settings.RESULT_FORMAT == "segments":
+        segment_writer().append(f"{folder}/{filename}", results)
+    else:
+        os.makedirs(f"{settings.DATA_FOLDER}{folder}", exist_ok=True)
+        filepath = f"{settings.DATA_FOLDER}{folder}/{filename}.json"
+        with open(filepath, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=4)
+    if SCANNED_URLS is not None:
+        SCANNED_URLS.add(f"{folder}/{filename}")
+
+def url_key(url):
+    """Key of a URL in the scanned URL index, "<folder>/<filename>" of its JSON file."""
     folder, filename = file_path_from_url(url)
-    os.makedirs(f"{settings.DATA_FOLDER}{folder}", exist_ok=True)
-    filepath = f"{settings.DATA_FOLDER}{folder}/{filename}.json"
-    with open(filepath, "w", encoding="utf-8") as json_file:
-        json.dump(results, json_file, indent=4)
+    return f"{folder}/{filename}"
 
-def partial_download(img_url, start, end):
-    """Download a partial range of bytes from the image."""
+def read_limited(response, limit):
+    """Read at most limit bytes of a streamed response body."""
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=limit):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return b"".join(chunks)[:limit]
+
+def total_size_from_headers(status_code, headers):
+    """Total size of the resource from Content-Range (206) or Content-Length (200), 0 if unknown."""
+    if status_code == 206:
+        total = headers.get("content-range", "").rpartition("/")[2].strip()
+    else:
+        total = headers.get("content-length", "").strip()
+    return int(total) if total.isdigit() else 0
+
+def ranged_get(img_url, start, end, validators=None):
+    """
+    Send a single ranged GET request and read at most end - start + 1 bytes,
+    even if the server ignores the Range header and sends the whole file.
+    Conditional request headers can be given in validators.
+    Returns (response headers, bytes, total size or 0 if unknown),
+    the bytes are None if the server answered 304 Not Modified.
+    """
+    headers = {}
     img_bytes = b""
+    total_size = 0
+    limit = end - start + 1
+    def get():
+        nonlocal headers, img_bytes, total_size
+        with pooled_session(img_url, "image_get") as session:
+            response = session.get(
+                img_url,
+                stream=True,
+                allow_redirects=True,
+                timeout=60,
+                headers={"Range": f"bytes={start}-{end}", **(validators or {})}
+            )
+            with response: # Closes the connection if the body is not read to the end
+                if response.status_code == 304: # The cached fingerprint is still valid
+                    headers = {k.lower(): v for k, v in response.headers.items()}
+                    img_bytes = None
+                elif response.status_code in [200, 206]:  # 206 indicates partial content
+                    headers = {k.lower(): v for k, v in response.headers.items()}
+                    if response.status_code == 200: # Range ignored, the body starts from 0
+                        img_bytes = read_limited(response, start + limit)[start:]
+                    else:
+                        img_bytes = read_limited(response, limit)
+                    metrics.count("image_bytes", len(img_bytes), url_domain(img_url))
+                    total_size = total_size_from_headers(response.status_code, headers)
+                    if not total_size and response.status_code == 200 and len(img_bytes) < limit:
+                        total_size = start + len(img_bytes) # The whole body was read
     try:
-        session = get_session_for_url(img_url)
-        response = session.get(
-            img_url,
-            stream=True,
-            allow_redirects=True,
-            timeout=60,
-            headers={"Range": f"bytes={start}-{end}"}
-        )
-        if response.status_code in [200, 206]:  # 206 indicates partial content
-            return response.content
-        return img_bytes
+        failover(img_url, get)
     except Exception:
-        return img_bytes
+        pass
+    return headers, img_bytes, total_size
+
+def partial_download(img_url, start, end):
+    """Download a partial range of bytes from the image."""
+    return ranged_get(img_url, start, end)[1]
 
 def head(resource_url):
     """Send a HEAD request to the resource."""
+    def send():
+        with pooled_session(resource_url, "head") as session:
+            return session.head(resource_url, allow_redirects=True, timeout=60)
     try:
-        session = get_session_for_url(resource_url)
-        response = session.head(resource_url, allow_redirects=True, timeout=60)
+        response = failover(resource_url, send)
         if response.status_code in [200, 206]:  # 206 indicates partial content
             return {k.lower(): v for k, v in response.headers.items()}
         return {}
     except Exception:
         return {}
 
-def extract_pil(start_bytes):
-    ''' Extract EXIF metadata '''
-    exif_data = {}
-    try:
-        img = Image.open(io.BytesIO(start_bytes))
-        exif_raw = img._getexif()
-        if exif_raw:
-            for tag, value in exif_raw.items():
-                # Convert EXIF values to JSON-serializable types
-                if isinstance(value, (bytes, bytearray)):
-                    value = value.decode(errors="ignore")  # Decode bytes if possible
-                else:
-                    value = str(value)  # Convert other types to string
-                exif_data[TAGS.get(tag, tag)] = value
-        return exif_data
-    except Exception:
-        return exif_data
-
 def clean_etag(etag):
     """Clean etag"""
     if not etag:
@@ -202,68 +467,6 @@ def clean_etag(etag):
         etag = etag[1:-1]
     return etag
 
-def extract_piexif(start_bytes):
-    """Extract EXIF metadata using piexif."""
-    exif_data = {}
-    try:
-        exif_dict = piexif.load(start_bytes)
-        for ifd_name in exif_dict:
-            json_data = sanitize_for_json(exif_dict[ifd_name])
-            for tag, value in json_data.items():
-                tag_name = piexif.TAGS[ifd_name][tag]["name"]
-                # Convert bytes to strings if necessary
-                if isinstance(value, bytes):
-                    try:
-                        value = value.decode(errors="ignore")  # Attempt to decode bytes
-                    except Exception:
-                        value = str(value)  # Fallback: Convert to string representation
-                exif_data[tag_name] = value
-        return exif_data
-    except Exception:
-        return exif_data
-
-def extract_metadata_with_exif_py(start_bytes):
-    """Extract EXIF metadata using the exif-py library."""
-    exif_data = {}
-    try:
-        # Parse EXIF tags from the given image bytes
-        tags = exifread.process_file(io.BytesIO(start_bytes), details=False)
-        for tag, value in tags.items():
-            # Convert tag values to strings to ensure JSON serialization
-            exif_data[tag] = str(value)
-        return exif_data
-    except Exception:
-        return exif_data
-
-def extract_metadata(start_bytes):
-    """Manually extract EXIF metadata from a JPEG """
-    exif_data = {}
-    exif_data = extract_metadata_with_exif_py(start_bytes)
-    if not exif_data:
-        exif_data = extract_pil(start_bytes)
-    if not exif_data:
-        exif_data = extract_piexif(start_bytes)
-    if not exif_data:
-        if b"Exif" in start_bytes: # Check for APP1 segment containing EXIF metadata
-            exif_start = start_bytes.find(b"Exif") + 6 # Start after "Exif\0\0"
-            start_bytes = start_bytes[exif_start:] # Extract potential EXIF segment
-            exif_data = extract_metadata_with_exif_py(start_bytes)
-            if not exif_data:
-                exif_data = extract_pil(start_bytes)
-            if not exif_data:
-                exif_data = extract_piexif(start_bytes)
-    return exif_data
-
-def sanitize_for_json(obj):
-    """Recursively convert non-JSON-serializable types (like bytes) to strings."""
-    if isinstance(obj, bytes):
-        return obj.decode(errors="ignore")  # Convert bytes to string
-    if isinstance(obj, dict):
-        return {key: sanitize_for_json(value) for key, value in obj.items()}
-    if isinstance(obj, list):
-        return [sanitize_for_json(item) for item in obj]
-    return obj  # Return other types unchanged
-
 def raw_image_data(start_bytes):
     """ Extract the start of the image data """
     image_data = b""
@@ -276,52 +479,199 @@ def raw_image_data(start_bytes):
     except Exception:
         return image_data
 
-def fetch_images(img_tags, base_url, test_head=None):
-    """Process images concurrently."""
-    results = []
-    max_workers = settings.MAX_THREADS  # Define the number of parallel threads
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit tasks for each image
-        max_img = settings.MAX_IMG_PER_DOMAIN
-        future_to_img = {
-            executor.submit(fetch_img, img, base_url, test_head): img for img in img_tags[:max_img]
-        }
-        for future in as_completed(future_to_img):
-            result = future.result()
-            if result:
-                results.append(result)
-    save_results(results, base_url)
+@metrics.timed("exif")
+def extract_exif(start_bytes):
+    """Extract EXIF metadata, in the process pool if settings.EXIF_PROCESSES is set."""
+    global EXIF_BATCHER
+    if not settings.EXIF_PROCESSES:
+        return extract_metadata(start_bytes)
+    with EXIF_BATCHER_LOCK:
+        if EXIF_BATCHER is None:
+            EXIF_BATCHER = ExifBatcher(settings.EXIF_PROCESSES, settings.EXIF_BATCH_SIZE,
+                                       settings.EXIF_BATCH_WAIT)
+    return EXIF_BATCHER.submit(start_bytes).result()
 
-def fetch_img(img_tag, base_url, test_head=None):
-    """Process a single image URL and return metadata."""
+def shutdown_exif_processes():
+    """Stop the EXIF worker processes."""
+    global EXIF_BATCHER
+    with EXIF_BATCHER_LOCK:
+        batcher, EXIF_BATCHER = EXIF_BATCHER, None
+    if batcher is not None:
+        batcher.shutdown()
+
+def resolve_img_url(img_tag, base_url):
+    """Full URL of an image URL or tag, or the base URL itself for a direct image link."""
     if img_tag == base_url:
-        img_url = base_url
+        return base_url
+    img_url = img_tag if isinstance(img_tag, str) else img_tag.get("src")
+    if img_url:
+        return urljoin(base_url, img_url)  # Resolve full image URL
+    return None
+
+@metrics.timed("thumbnail_hash")
+def add_thumbnail_hash(metadata, start_bytes):
+    """Add the perceptual hash of the EXIF thumbnail, if settings.THUMBNAIL_HASH is set and it is in the start."""
+    if settings.THUMBNAIL_HASH:
+        phash_hex = thumbnail_phash(start_bytes)
+        if phash_hex:
+            metadata["thumbnail_phash"] = phash_hex
+
+def image_metadata(img_url, test_head, total_size, start_bytes):
+    """
+    Build the metadata of an image from its headers and the first bytes, and compare it.
+    The fingerprint is taken from the first FINGERPRINT_SIZE bytes,
+    the EXIF metadata from all of start_bytes.
+    """
+    metadata = {
+        "url": img_url,
+        "image_size": total_size,
+        "etag": clean_etag(test_head.get("etag", "")),
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    fingerprint_bytes = start_bytes[:FINGERPRINT_SIZE] if start_bytes else start_bytes
+    if start_bytes:
+        print(f"Downloaded a small sample of the image: {img_url}", flush=True)
+        metadata["exif"] = extract_exif(start_bytes)
+        metadata["sha256_first_10240_bytes"] = sha256(fingerprint_bytes).hexdigest()
+        # 128 bytes sample
+        metadata["random_128_bytes_sample_start"] = fingerprint_bytes[-128:].hex()
+        add_thumbnail_hash(metadata, start_bytes)
+    if total_size < settings.MIN_IMAGE_SIZE:
+        counter = "images_small"
     else:
-        img_url = img_tag.get("src")
+        counter = "images_fingerprinted" if start_bytes else "images_failed"
+    metrics.count(counter, domain=url_domain(img_url))
+    compare_images(metadata, fingerprint_bytes)
+    return metadata
+
+def probe_end():
+    """Last byte of the first range request of an image."""
+    if settings.ADAPTIVE_PROBE:
+        return settings.ADAPTIVE_PROBE_SIZE - 1
+    return FINGERPRINT_END
+
+def follow_up_range(start_bytes, total_size):
+    """
+    Range (start, end) still needed after an adaptive probe, or None.
+    It covers the rest of the fingerprint and the metadata segments,
+    so the metadata is not truncated at 10KB.
+    """
+    if total_size and len(start_bytes) >= total_size:
+        return None # The whole file is already downloaded
+    end = max(FINGERPRINT_END, (jpeg_metadata_end(start_bytes) or 0) - 1)
+    end = min(end, settings.ADAPTIVE_MAX_BYTES - 1)
+    if total_size:
+        end = min(end, total_size - 1)
+    if end < len(start_bytes):
+        return None
+    return len(start_bytes), end
+
+def download_failed(start_bytes, total_size):
+    """
+    The first bytes of an image above MIN_IMAGE_SIZE are missing or shorter than the fingerprint,
+    e.g. a failed follow-up range, no fingerprint is taken from them.
+    """
+    return total_size >= settings.MIN_IMAGE_SIZE and len(start_bytes or b"") < FINGERPRINT_SIZE
+
+def fetch_cache():
+    """The fetch cache, None if settings.FETCH_CACHE is not set."""
+    global FETCH_CACHE
+    if not settings.FETCH_CACHE:
+        return None
+    with FETCH_CACHE_LOCK:
+        if FETCH_CACHE is None:
+            FETCH_CACHE = FetchCache(settings.FETCH_CACHE, settings.FETCH_CACHE_SIZE,
+                                     settings.FETCH_CACHE_TTL)
+    return FETCH_CACHE
+
+def close_fetch_cache():
+    """Close the fetch cache."""
+    global FETCH_CACHE
+    with FETCH_CACHE_LOCK:
+        cache, FETCH_CACHE = FETCH_CACHE, None
+    if cache is not None:
+        cache.close()
+
+def cache_entry(img_url):
+    """Cached fingerprint of an image URL, or None."""
+    cache = fetch_cache()
+    return cache.get(img_url) if cache else None
+
+def is_fresh(entry):
+    """The entry was validated recently enough to be reused without a request."""
+    return entry is not None and time.time() - entry.fetched_at < settings.FETCH_CACHE_FRESH
+
+def cached_image_metadata(img_url, entry, revalidated=False):
+    """
+    Build the metadata of an unchanged image from its cache entry, and compare it.
+    The 128-byte samples are not compared, that needs the image bytes.
+    """
+    if revalidated:
+        fetch_cache().revalidated(img_url)
+    metrics.count("cache_revalidated" if revalidated else "cache_fresh", domain=url_domain(img_url))
+    metadata = {
+        "url": img_url,
+        "image_size": entry.image_size,
+        "etag": clean_etag(entry.etag or ""),
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        **entry.fields,
+    }
+    print(f"Reused the cached fingerprint of the image: {img_url}", flush=True)
+    compare_images(metadata)
+    return metadata
+
+def cache_image_metadata(img_url, test_head, metadata):
+    """Store the fingerprint of a downloaded image in the fetch cache."""
+    cache = fetch_cache()
+    if cache and test_head: # Failed requests are not cached
+        cache.put(img_url, test_head, metadata["image_size"],
+                  {field: metadata[field] for field in CACHED_FIELDS if field in metadata})
+
+def fetch_img(img_tag, base_url, test_head=None):
+    """Process a single image URL and return metadata."""
+    img_url = resolve_img_url(img_tag, base_url)
     if img_url:
-        if img_url != base_url:
-            img_url = urljoin(base_url, img_url)  # Resolve full image URL
+        return IMAGE_FETCHES.do(img_url, metrics.profiled, fetch_image_url, img_url, test_head)
+    return None
+
+def fetch_image_url(img_url, test_head=None):
+    """Download the first bytes of an image, or reuse its cached fingerprint, and return metadata."""
+    entry = cache_entry(img_url)
+    if is_fresh(entry):
+        return cached_image_metadata(img_url, entry)
+    start_bytes = None
+    if not test_head and settings.SINGLE_REQUEST_FETCH:
+        # One ranged GET returns the first bytes, the total size and the etag
+        test_head, start_bytes, total_size = ranged_get(
+            img_url, 0, probe_end(), entry.validators() if entry else None)
+        if start_bytes is None and entry: # 304 Not Modified
+            return cached_image_metadata(img_url, entry, revalidated=True)
+        if start_bytes and not total_size: # Size is still unknown, ask it for the size filtering
+            head_response = head(img_url)
+            total_size = int(head_response.get("content-length", "0"))
+            test_head = {**head_response, **test_head}
+    else:
         if not test_head:
             test_head = head(img_url)
+        if entry and entry.matches(test_head): # Same etag or Last-Modified
+            return cached_image_metadata(img_url, entry, revalidated=True)
         total_size = int(test_head.get("content-length", "0"))
-        metadata = {
-            "url": img_url,
-            "image_size": total_size,
-            "etag": clean_etag(test_head.get("etag", "")),
-            "timestamp": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        }
+    if total_size < settings.MIN_IMAGE_SIZE:  # Ignore small images
         start_bytes = None
-        if total_size >= settings.MIN_IMAGE_SIZE:  # Ignore small images
-            start_bytes = partial_download(img_url, 0, 10240)  # First 10KB of the image
-            if start_bytes:
-                print(f"Downloaded a small sample of the image: {img_url}", flush=True)
-                metadata["exif"] = extract_metadata(start_bytes)
-                metadata["sha256_first_10240_bytes"] = sha256(start_bytes).hexdigest()
-                # 128 bytes sample
-                metadata["random_128_bytes_sample_start"] = start_bytes[-128:].hex()
-        compare_images(metadata, start_bytes)
-        return metadata
-    return None
+    elif start_bytes is None:
+        start_bytes = partial_download(img_url, 0, probe_end())  # First bytes of the image
+    if start_bytes and settings.ADAPTIVE_PROBE:
+        follow_up = follow_up_range(start_bytes, total_size)
+        if follow_up: # At most one more request
+            start_bytes += partial_download(img_url, *follow_up)
+    failed = download_failed(start_bytes, total_size)
+    if failed:
+        print(f"Failed to download the first bytes of the image: {img_url}", flush=True)
+        start_bytes = None
+    metadata = image_metadata(img_url, test_head, total_size, start_bytes)
+    if not failed: # A failed download is tried again by the next crawl
+        cache_image_metadata(img_url, test_head, metadata)
+    return metadata
 
 def process_image_file(image_path):
     """Process a local image file and return metadata."""
@@ -333,7 +683,7 @@ def process_image_file(image_path):
             start_bytes = file.read(10240)  # First 10KB
         if not start_bytes:
             return None
-        exif_data = extract_metadata(start_bytes)
+        exif_data = extract_exif(start_bytes)
         start_sample = start_bytes[-128:].hex()  # 128 bytes sample from end of start_bytes
         sha256_first_bytes = sha256(start_bytes).hexdigest()
         metadata = {
@@ -344,60 +694,158 @@ def process_image_file(image_path):
             "sha256_first_10240_bytes": sha256_first_bytes,
             "random_128_bytes_sample_start": start_sample,
         }
+        add_thumbnail_hash(metadata, start_bytes)
         compare_images(metadata, start_bytes)
         return metadata
     except Exception as e:
         print(f"Failed to process local image {image_path}: {e}", flush=True)
         return None
 
-def read_urls_from_file(file_path):
-    """Reads URLs from a file and returns them as a list"""
+def open_scanned_urls():
+    """Open the index of the scanned URLs if settings.URL_INDEX is set."""
+    global SCANNED_URLS
+    if settings.URL_INDEX and SCANNED_URLS is None:
+        SCANNED_URLS = ScannedUrlIndex(settings.URL_INDEX, settings.DATA_FOLDER)
+
+def is_saved(url):
+    """Check if the results of a URL are already saved."""
+    if SCANNED_URLS is not None:
+        return url_key(url) in SCANNED_URLS
+    folder, filename = file_path_from_url(url)
+    return os.path.isfile(f"{settings.DATA_FOLDER}{folder}/{filename}.json")
+
+def open_url_feed(file_path):
+    """Streaming reader of the new URLs of a file, see url_index.UrlFeed."""
+    open_scanned_urls()
+    return UrlFeed(file_path, url_key, settings.DATA_FOLDER, SCANNED_URLS)
+
+def url_domain(url):
+    """Domain of a URL for the scheduling and the image quota."""
+    return urlparse(url).netloc.lower()
+
+class PageCrawl:
+    """The image tasks of a page, its results are saved when the last one is done."""
+
+    def __init__(self, url, image_count, future):
+        self.url = url
+        self.results = [None] * image_count # In the page order
+        self.remaining = image_count
+        self.future = future # Done when the results are saved
+        self.lock = threading.Lock()
+
+    def fail(self, error):
+        """The page failed, the first error is reported."""
+        with self.lock:
+            if self.future.done():
+                return
+            self.future.set_exception(error)
+
+    def image_done(self, position, image_future):
+        """Collect the result of an image task, save the results after the last one."""
+        try:
+            result = image_future.result()
+        except BaseException as error:
+            self.fail(error)
+            return
+        with self.lock:
+            self.results[position] = result
+            self.remaining -= 1
+            if self.remaining or self.future.done():
+                return
+        try:
+            save_results([metadata for metadata in self.results if metadata], self.url)
+        except Exception as error:
+            self.fail(error)
+            return
+        self.future.set_result(None)
+
+def crawl_page(scheduler, quota, resource_url, page_future):
+    """Page task: find the images of a URL and schedule their image tasks."""
+    try:
+        found = page_images(resource_url)
+        if found is None: # Not an image or an HTML page
+            page_future.set_result(None)
+            return
+        img_urls, test_head = found
+        if test_head is None: # Images of an HTML page, limited per domain
+            img_urls = quota.allow(url_domain(resource_url), img_urls)
+        page = PageCrawl(resource_url, len(img_urls), page_future)
+        if not img_urls:
+            save_results([], resource_url)
+            page_future.set_result(None)
+            return
+        for position, img_url in enumerate(img_urls):
+            image_future = scheduler.submit(url_domain(img_url), IMAGE, fetch_img, img_url, resource_url, test_head)
+            image_future.add_done_callback(lambda done, position=position: page.image_done(position, done))
+    except BaseException as error:
+        if not page_future.done():
+            page_future.set_exception(error)
+
+def crawl_urls(url_feed):
+    """
+    Download the image metadata of the URLs with one fair scheduler of the page and image tasks.
+    At most settings.CRAWL_WORKERS pages are in progress, the next URLs are read when one is done.
+    """
+    scheduler = DomainScheduler(settings.CRAWL_WORKERS, settings.DOMAIN_MAX_IN_FLIGHT,
+                                settings.DOMAIN_MIN_INTERVAL)
+    quota = DomainQuota(settings.MAX_IMG_PER_DOMAIN)
+    pages = {} # Future of the page -> url
     try:
-        urls = []
-        with open(file_path, "r", encoding="utf-8") as file:
-            for line in file:
-                if line.startswith('http'):
-                    url = line.split()[0].strip()
-                    folder, filename = file_path_from_url(url)
-                    if os.path.isfile(f"{settings.DATA_FOLDER}{folder}/{filename}.json"):
-                        continue # Already downloaded
-                    urls.append(url)
-        urls = list(set(urls))
-        if not urls:
-            print(f"No new (not already scanned) URLs in a file: {file_path}", flush=True)
-        else:
-            print(f"Loaded {len(urls)} new URLs from a file: {file_path}", flush=True)
-        return urls
-    except FileNotFoundError:
-        print(f"File not found: {file_path}", flush=True)
-        return []
-    except Exception as error:
-        print(f"Error reading file: {error}", flush=True)
-        return []
+        for url in url_feed:
+            page_future = Future()
+            scheduler.submit(url_domain(url), PAGE, crawl_page, scheduler, quota, url, page_future)
+            pages[page_future] = url
+            if len(pages) >= settings.CRAWL_WORKERS:
+                done, _ = wait(pages, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    url_feed.done(pages.pop(fut))
+                    fut.result()
+        for fut in as_completed(pages):
+            url_feed.done(pages[fut])
+            fut.result()
+    except BaseException:
+        scheduler.shutdown(cancel=True)
+        raise
+    scheduler.shutdown()
 
 def main():
     """ Main function """
     if settings.ONLY_COMPARE_EXISTING_DATA:
-        all_metadata = load_all_metadata()
-        for _, metadata_list in all_metadata.items():
-            for metadata in metadata_list:
-                compare_images(metadata)
+        report_duplicates() # Batch self-join of the collected data
         return
-    if settings.TEST_IMAGES_FOLDER and os.path.exists(settings.TEST_IMAGES_FOLDER):
-        images = glob(f'{settings.TEST_IMAGES_FOLDER}*')
-        for image in images:
-            folder, filename = file_path_from_url(image)
-            if os.path.isfile(f"{settings.DATA_FOLDER}{folder}/{filename}.json"):
-                continue # Already processed
-            metadata_item = process_image_file(image)
-            if metadata_item:
-                save_results([metadata_item], image)
-    if settings.URL_FILE and os.path.isfile(settings.URL_FILE):
-        url_list = read_urls_from_file(settings.URL_FILE)
-        with ThreadPoolExecutor(max_workers=settings.MAX_THREADS) as exe: # Use the thread limit
-            future_list = {exe.submit(download_image_metadata, url): url for url in url_list}
-            for fut in as_completed(future_list):
-                fut.result()
+    if settings.METRICS_FILE:
+        metrics.start(settings.METRICS_FILE, settings.METRICS_FORMAT, settings.METRICS_INTERVAL,
+                      settings.METRICS_MAX_DOMAINS, settings.PROFILE_FILE, settings.PROFILE_SAMPLE_RATE)
+    try:
+        open_scanned_urls()
+        if settings.TEST_IMAGES_FOLDER and os.path.exists(settings.TEST_IMAGES_FOLDER):
+            images = glob(f'{settings.TEST_IMAGES_FOLDER}*')
+            for image in images:
+                if is_saved(image):
+                    continue # Already processed
+                metadata_item = process_image_file(image)
+                if metadata_item:
+                    save_results([metadata_item], image)
+        if settings.URL_FILE and os.path.isfile(settings.URL_FILE):
+            url_feed = open_url_feed(settings.URL_FILE)
+            try:
+                if settings.CRAWL_ENGINE == "asyncio":
+                    import async_crawler # Optional dependency: aiohttp
+                    async_crawler.crawl_urls(url_feed)
+                else:
+                    crawl_urls(url_feed)
+            except BaseException:
+                url_feed.save_checkpoint() # Resume from here on the next run
+                raise
+            url_feed.save_checkpoint(complete=True)
+    finally:
+        SESSION_POOL.close()
+        shutdown_exif_processes()
+        close_fetch_cache()
+        close_segment_writer()
+        if SCANNED_URLS is not None:
+            SCANNED_URLS.close()
+        metrics.stop()
 
 if __name__ == "__main__":
     main()
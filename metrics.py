@@ -0,0 +1,316 @@
+"""
+Instrumentation of the crawl stages.
+Each stage (request, EXIF parsing, comparison, saving...) has a call count, an error count
+and a latency histogram, labelled by domain and proxy, and there are counters (bytes, cache hits).
+The metrics are exported periodically as a JSON stats file or in the Prometheus text format.
+An optional sampling profiler runs cProfile on a fraction of the calls of profiled().
+Disabled (start() not called), timer() returns a shared no-op context manager.
+"""
+import os
+import json
+import time
+import random
+import cProfile
+import pstats
+import threading
+import functools
+from contextlib import nullcontext
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.9, 0.99)
+PREFIX = "image_fingerprint" # Prefix of the Prometheus metric names
+OTHER_DOMAINS = "other" # Domain label above the max number of domains
+
+METRICS = None # The Metrics of the run, None when disabled
+EXPORTER = None
+PROFILER = None
+NO_TIMER = nullcontext()
+
+class Series:
+    """Calls, errors and latency histogram of a stage for one domain and proxy."""
+    __slots__ = ("count", "errors", "seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds, error):
+        """Record one call."""
+        self.count += 1
+        self.seconds += seconds
+        if error:
+            self.errors += 1
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def merge(self, other):
+        """Add the calls of another series."""
+        self.count += other.count
+        self.errors += other.errors
+        self.seconds += other.seconds
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q):
+        """Estimated latency quantile, the upper bound of its bucket."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+        return None
+
+    def summary(self):
+        """The series as a JSON-serializable dict."""
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 6),
+            "mean": round(self.seconds / self.count, 6) if self.count else None,
+            **{f"p{round(q * 100)}": self.quantile(q) for q in QUANTILES},
+        }
+
+class Metrics:
+    """Stage series and counters, thread-safe."""
+
+    def __init__(self, max_domains=1000):
+        self.max_domains = max_domains # Distinct domain labels, the others are counted as OTHER_DOMAINS
+        self.lock = threading.Lock()
+        self.series = {} # (stage, domain, proxy) -> Series
+        self.counters = {} # (name, domain, proxy) -> value
+        self.domains = set()
+        self.started = time.time()
+
+    def domain_label(self, domain):
+        """Domain label within the max number of domains, call with the lock held."""
+        if not domain or not self.max_domains:
+            return ""
+        if domain not in self.domains:
+            if len(self.domains) >= self.max_domains:
+                return OTHER_DOMAINS
+            self.domains.add(domain)
+        return domain
+
+    def observe(self, stage, seconds, domain=None, proxy=None, error=False):
+        """Record a call of a stage."""
+        with self.lock:
+            key = (stage, self.domain_label(domain), proxy or "")
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series()
+            series.observe(seconds, error)
+
+    def add(self, name, value=1, domain=None, proxy=None):
+        """Add to a counter."""
+        with self.lock:
+            key = (name, self.domain_label(domain), proxy or "")
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        """Copies of the series and counters."""
+        with self.lock:
+            series = {}
+            for key, value in self.series.items():
+                series[key] = copy = Series()
+                copy.merge(value)
+            return series, dict(self.counters)
+
+    def to_json(self):
+        """The metrics as a dict: totals per stage and counter, and the labelled series."""
+        series, counters = self.snapshot()
+        stages = {}
+        for (stage, _, _), value in series.items():
+            stages.setdefault(stage, Series()).merge(value)
+        totals = {}
+        for (name, _, _), value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "uptime": round(time.time() - self.started, 3),
+            "stages": {stage: value.summary() for stage, value in sorted(stages.items())},
+            "counters": dict(sorted(totals.items())),
+            "series": [{"stage": stage, "domain": domain, "proxy": proxy, **value.summary()}
+                       for (stage, domain, proxy), value in sorted(series.items())],
+            "labelled_counters": [{"name": name, "domain": domain, "proxy": proxy, "value": value}
+                                  for (name, domain, proxy), value in sorted(counters.items())],
+        }
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        series, counters = self.snapshot()
+        lines = [f"# TYPE {PREFIX}_stage_seconds histogram"]
+        for (stage, domain, proxy), value in sorted(series.items()):
+            labels = f'stage="{escape(stage)}",domain="{escape(domain)}",proxy="{escape(proxy)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), value.buckets):
+                cumulative += count
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{PREFIX}_stage_seconds_sum{{{labels}}} {value.seconds}")
+            lines.append(f"{PREFIX}_stage_seconds_count{{{labels}}} {value.count}")
+        lines.append(f"# TYPE {PREFIX}_stage_errors_total counter")
+        for (stage, domain, proxy), value in sorted(series.items()):
+            labels = f'stage="{escape(stage)}",domain="{escape(domain)}",proxy="{escape(proxy)}"'
+            lines.append(f"{PREFIX}_stage_errors_total{{{labels}}} {value.errors}")
+        for name in sorted({name for name, _, _ in counters}):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            for (counter, domain, proxy), value in sorted(counters.items()):
+                if counter == name:
+                    labels = f'domain="{escape(domain)}",proxy="{escape(proxy)}"'
+                    lines.append(f"{PREFIX}_{name}_total{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, file_path, metrics_format):
+        """Write the metrics file, replaced at once so readers never see a partial file."""
+        if metrics_format == "prometheus":
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_json(), indent=4)
+        temporary_path = f"{file_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(text)
+        os.replace(temporary_path, file_path)
+
+def escape(value):
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Timer:
+    """Context manager timing one call of a stage, an exception counts as an error."""
+    __slots__ = ("metrics", "stage", "domain", "proxy", "start")
+
+    def __init__(self, metrics, stage, domain, proxy):
+        self.metrics = metrics
+        self.stage = stage
+        self.domain = domain
+        self.proxy = proxy
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.domain, self.proxy,
+                             error_type is not None)
+        return False
+
+class Exporter:
+    """Export the metrics, and the profile, every interval seconds in a background thread."""
+
+    def __init__(self, metrics, file_path, metrics_format, interval):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def export(self):
+        """Write the files now, an export error does not stop the crawl."""
+        try:
+            self.metrics.export(self.file_path, self.metrics_format)
+            if PROFILER is not None:
+                PROFILER.export()
+        except Exception as error:
+            print(f"Failed to export the metrics: {error}", flush=True)
+
+    def run(self):
+        """Export loop."""
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        """Stop the thread and write the final files."""
+        self.stopped.set()
+        self.thread.join()
+        self.export()
+
+class SamplingProfiler:
+    """Profile a random fraction of the calls, one at a time, and accumulate their stats."""
+
+    def __init__(self, file_path, rate):
+        self.file_path = file_path
+        self.rate = rate
+        self.busy = threading.Lock() # One profiler can be active at a time
+        self.lock = threading.Lock()
+        self.stats = None
+        self.calls = 0
+
+    def call(self, func, *args):
+        """Call func(*args), under the profiler if sampled and no other call is profiled."""
+        if random.random() >= self.rate or not self.busy.acquire(blocking=False):
+            return func(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    self.calls += 1
+        finally:
+            self.busy.release()
+
+    def export(self):
+        """Write the accumulated stats, read them with: python -m pstats <file>"""
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(self.file_path)
+
+def start(file_path, metrics_format="json", interval=10, max_domains=1000,
+          profile_path=None, profile_rate=0.01):
+    """Enable the metrics, exported to file_path every interval seconds."""
+    global METRICS, EXPORTER, PROFILER
+    METRICS = Metrics(max_domains)
+    if profile_path:
+        PROFILER = SamplingProfiler(profile_path, profile_rate)
+    EXPORTER = Exporter(METRICS, file_path, metrics_format, interval)
+
+def stop():
+    """Write the final metrics and disable them."""
+    global METRICS, EXPORTER, PROFILER
+    if EXPORTER is not None:
+        EXPORTER.stop()
+    METRICS = EXPORTER = PROFILER = None
+
+def timer(stage, domain=None, proxy=None):
+    """Context manager timing a call of a stage, a no-op when disabled."""
+    metrics = METRICS
+    if metrics is None:
+        return NO_TIMER
+    return Timer(metrics, stage, domain, proxy)
+
+def timed(stage):
+    """Decorator timing the calls of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = METRICS
+            if metrics is None:
+                return func(*args, **kwargs)
+            with Timer(metrics, stage, None, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1, domain=None, proxy=None):
+    """Add to a counter, a no-op when disabled."""
+    metrics = METRICS
+    if metrics is not None:
+        metrics.add(name, value, domain, proxy)
+
+def profiled(func, *args):
+    """Call func(*args), profiled for a sample of the calls if the profiler is enabled."""
+    profiler = PROFILER
+    if profiler is None:
+        return func(*args)
+    return profiler.call(func, *args)
@@ -0,0 +1,103 @@
+"""
+Perceptual hash (pHash) of the EXIF thumbnail embedded in the start of a JPEG.
+A re-encoded, resized or re-saved copy of a photo keeps a similar thumbnail,
+so the copies are found by the Hamming distance between the thumbnail hashes.
+The thumbnail is located from the IFD1 tags of the EXIF (APP1) segment,
+and hashed only if it is entirely within the downloaded bytes.
+"""
+import io
+import struct
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8 # 8x8 lowest DCT frequencies, a 64-bit hash
+DCT_SIZE = 32 # The thumbnail is reduced to 32x32 gray pixels
+MIN_CONTRAST = 1.0 # Standard deviation of the pixels, flatter thumbnails get no hash
+TAG_THUMBNAIL_OFFSET = 0x0201 # JPEGInterchangeFormat
+TAG_THUMBNAIL_LENGTH = 0x0202 # JPEGInterchangeFormatLength
+TYPE_SHORT = 3
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8) # Set bits of each byte
+
+def dct_matrix(size):
+    """Orthonormal DCT-II matrix, rows are the frequencies."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+DCT_LOW = dct_matrix(DCT_SIZE)[:HASH_SIZE] # Only the lowest frequencies are computed
+
+def exif_tiff_offset(start_bytes):
+    """Offset of the TIFF header in the EXIF segment of a JPEG start, None if there is none."""
+    if start_bytes[:3] != b"\xff\xd8\xff":
+        return None
+    offset = 2 # After the SOI marker
+    while offset + 4 <= len(start_bytes) and start_bytes[offset] == 0xFF:
+        marker = start_bytes[offset + 1]
+        if marker == 0xFF: # Fill byte
+            offset += 1
+            continue
+        if not (0xE0 <= marker <= 0xEF or marker == 0xFE): # Not APPn or COM, image data follows
+            return None
+        if marker == 0xE1 and start_bytes[offset + 4:offset + 10] == b"Exif\x00\x00":
+            return offset + 10
+        offset += 2 + int.from_bytes(start_bytes[offset + 2:offset + 4], "big")
+    return None
+
+def exif_thumbnail(start_bytes):
+    """JPEG thumbnail of the EXIF segment, None if there is none or it is not complete in start_bytes."""
+    tiff = exif_tiff_offset(start_bytes)
+    if tiff is None:
+        return None
+    byte_order = {b"II": "<", b"MM": ">"}.get(start_bytes[tiff:tiff + 2])
+    if byte_order is None:
+        return None
+    values = {}
+    try:
+        ifd0 = struct.unpack_from(f"{byte_order}I", start_bytes, tiff + 4)[0]
+        (count,) = struct.unpack_from(f"{byte_order}H", start_bytes, tiff + ifd0)
+        ifd1 = struct.unpack_from(f"{byte_order}I", start_bytes, tiff + ifd0 + 2 + 12 * count)[0]
+        if not ifd1:
+            return None
+        (count,) = struct.unpack_from(f"{byte_order}H", start_bytes, tiff + ifd1)
+        for entry in range(tiff + ifd1 + 2, tiff + ifd1 + 2 + 12 * count, 12):
+            tag, value_type = struct.unpack_from(f"{byte_order}HH", start_bytes, entry)
+            if tag in (TAG_THUMBNAIL_OFFSET, TAG_THUMBNAIL_LENGTH):
+                value_format = "H" if value_type == TYPE_SHORT else "I"
+                values[tag] = struct.unpack_from(f"{byte_order}{value_format}", start_bytes, entry + 8)[0]
+    except struct.error: # IFDs beyond start_bytes
+        return None
+    offset = values.get(TAG_THUMBNAIL_OFFSET)
+    length = values.get(TAG_THUMBNAIL_LENGTH)
+    if not offset or not length or tiff + offset + length > len(start_bytes):
+        return None
+    thumbnail = start_bytes[tiff + offset:tiff + offset + length]
+    return thumbnail if thumbnail[:2] == b"\xff\xd8" else None
+
+def phash(image_bytes):
+    """64-bit DCT perceptual hash of an image as an int, None if it cannot be decoded or is flat."""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft("L", (DCT_SIZE, DCT_SIZE)) # JPEG: decode directly at a reduced scale
+        pixels = np.asarray(img.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR),
+                            dtype=np.float64)
+    except Exception:
+        return None
+    if pixels.std() < MIN_CONTRAST:
+        return None
+    low = DCT_LOW @ pixels @ DCT_LOW.T
+    bits = (low > np.median(low.flat[1:])).ravel() # The DC term is left out of the median
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def thumbnail_phash(start_bytes):
+    """Hex pHash of the EXIF thumbnail in the start of an image, None if there is no usable thumbnail."""
+    thumbnail = exif_thumbnail(start_bytes)
+    if thumbnail is None:
+        return None
+    value = phash(thumbnail)
+    return None if value is None else f"{value:016x}"
+
+def hamming_distances(hashes, value):
+    """Number of bits of each hash of a uint64 array that differ from a hash."""
+    return POPCOUNT[(hashes ^ np.uint64(value)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
@@ -0,0 +1,155 @@
+"""
+Pool of the Tor SOCKS proxies with a stable onion domain affinity.
+Each domain ranks the proxies by rendezvous (highest random weight) hashing,
+so adding or removing a proxy only moves the domains of that proxy.
+The latency, errors and in-flight requests of each proxy are tracked.
+A proxy that keeps failing, or is much slower than the others, is ejected for a while
+and its domains fail over to their next proxy in rank.
+"""
+import time
+import threading
+from hashlib import blake2b
+from functools import lru_cache
+from contextlib import contextmanager
+from statistics import median
+
+LATENCY_WEIGHT = 0.2 # Weight of a new sample in the moving average of the latency
+MIN_LATENCY_SAMPLES = 5 # Latency samples of a proxy before it can be ejected for being slow
+MAX_BACKOFF = 5 # The ejection time doubles after each ejection in a row, up to 2**MAX_BACKOFF
+
+def error_chain(error):
+    """The error and the errors it wraps (cause, context, reason and arguments)."""
+    seen = set()
+    stack = [error]
+    while stack:
+        error = stack.pop()
+        if id(error) in seen:
+            continue
+        seen.add(id(error))
+        yield error
+        stack.extend(wrapped for wrapped in (error.__cause__, error.__context__,
+                                             getattr(error, "reason", None), *error.args)
+                     if isinstance(wrapped, BaseException))
+
+@lru_cache(maxsize=65536)
+def rendezvous_order(domain, proxy_keys):
+    """Proxy indexes in the order of preference of the domain, highest random weight first."""
+    def weight(index):
+        key = f"{domain}|{proxy_keys[index]}".encode("utf-8")
+        return blake2b(key, digest_size=8).digest()
+    return tuple(sorted(range(len(proxy_keys)), key=weight, reverse=True))
+
+class ProxyState:
+    """Health of a proxy."""
+    __slots__ = ("key", "in_flight", "latency", "samples", "failures", "ejections", "ejected_until",
+                 "requests", "errors")
+
+    def __init__(self, key):
+        self.key = key # Proxy URL, the identity of the proxy for the hashing
+        self.in_flight = 0
+        self.latency = None # Moving average in seconds, None until measured
+        self.samples = 0 # Latency samples in the moving average
+        self.failures = 0 # Failures in a row
+        self.ejections = 0 # Ejections in a row
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+class ProxyPool:
+    """
+    Select a proxy for a domain and track the outcome of its requests.
+    At most max_in_flight requests go through a proxy at the same time with use().
+    """
+
+    def __init__(self, proxies, max_in_flight=20, max_failures=3, eject_seconds=60,
+                 slow_factor=5.0, clock=time.monotonic):
+        self.proxies = proxies # settings.PROXIES
+        self.states = [ProxyState(proxy.get("http") or proxy.get("https")) for proxy in proxies]
+        self.keys = tuple(state.key for state in self.states)
+        self.slots = [threading.BoundedSemaphore(max_in_flight) for _ in proxies]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor # Eject a proxy this many times slower than the median
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def select(self, domain):
+        """Index of the proxy for the domain, the first proxy in its rank that is not ejected."""
+        order = rendezvous_order(domain, self.keys)
+        now = self.clock()
+        with self.lock:
+            for index in order:
+                if self.states[index].ejected_until <= now:
+                    return index
+        return order[0] # All ejected, keep the affinity
+
+    def eject(self, state, now):
+        """Eject a proxy, longer after each ejection in a row, call with the lock held."""
+        state.ejected_until = now + self.eject_seconds * 2 ** min(state.ejections, MAX_BACKOFF)
+        state.ejections += 1
+        state.failures = 0
+        state.latency = None # Measured again after the ejection
+        state.samples = 0
+
+    def record(self, index, latency, failed=False):
+        """
+        Record the outcome of a request through a proxy.
+        latency is None for a request that failed behind the proxy (the site is down),
+        it says nothing about the proxy.
+        """
+        now = self.clock()
+        with self.lock:
+            state = self.states[index]
+            state.requests += 1
+            if failed:
+                state.errors += 1
+                state.failures += 1
+                if state.failures >= self.max_failures:
+                    self.eject(state, now)
+                return
+            if latency is None:
+                state.errors += 1
+                return
+            state.failures = 0
+            state.ejections = 0
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += LATENCY_WEIGHT * (latency - state.latency)
+            state.samples += 1
+            if state.samples < MIN_LATENCY_SAMPLES:
+                return
+            others = [other.latency for other in self.states
+                      if other is not state and other.latency is not None and other.ejected_until <= now]
+            if others and state.latency > self.slow_factor * median(others):
+                self.eject(state, now)
+
+    def begin(self, index):
+        """A request through a proxy starts, returns its start time for end()."""
+        with self.lock:
+            self.states[index].in_flight += 1
+        return self.clock()
+
+    def end(self, index, start, error=None, is_failure=None):
+        """
+        A request through a proxy ends, record its outcome.
+        is_failure(error) tells if an error of the request is a failure of the proxy itself.
+        """
+        with self.lock:
+            self.states[index].in_flight -= 1
+        if error is None:
+            self.record(index, self.clock() - start)
+        else:
+            self.record(index, None, failed=is_failure(error))
+
+    @contextmanager
+    def use(self, index, is_failure):
+        """Hold one of the in-flight slots of a proxy for a request and record its outcome."""
+        with self.slots[index]:
+            start = self.begin(index)
+            try:
+                yield
+            except Exception as error:
+                self.end(index, start, error, is_failure)
+                raise
+            self.end(index, start)
@@ -0,0 +1,352 @@
+"""
+Compact binary result format, an alternative to one indented JSON file per page.
+The results are appended to segment files in <folder>segments/, each record holds
+the metadata list of one page under its "<folder>/<filename>" key, like the JSON layout.
+A record is length-prefixed, the fingerprint fields (digest, sample, thumbnail hash, url, etag)
+are stored in binary fields before a JSON rest holding the other metadata (EXIF etc.),
+and a sidecar index (.idx) holds the offset and length of each record.
+The segments are scanned through mmap, the JSON rest is parsed only if the full metadata is read
+or it holds a fingerprint field that did not fit the binary fields.
+A record is visible once its index entry is written, a later record of the same key replaces it.
+Export to and import from the JSON layout:
+python result_segments.py export|import
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import threading
+from glob import glob
+from fingerprint_store import read_json_file
+import settings # Import the settings from settings.py
+
+SEGMENTS = "segments" # Folder of the segments in DATA_FOLDER and the archive folders
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+INDEX_ENTRY = struct.Struct("<QI") # Offset and length of a record in its segment
+LENGTH = struct.Struct("<I") # Length prefix of a record
+KEY_HEADER = struct.Struct("<HH") # Key length, image count
+# Flags, fixed sha256 and sample fields, url, etag and rest lengths
+IMAGE_HEADER = struct.Struct("<B32s128sHHI")
+HAS_URL = 1
+HAS_SHA256 = 2 # 32-byte digest of a 64-digit hex sha256_first_10240_bytes
+HAS_SAMPLE = 4 # 128-byte random_128_bytes_sample_start
+HAS_ETAG = 8 # String etag
+ETAG_NONE = 16 # etag null
+HAS_PHASH = 32 # 8-byte thumbnail_phash after the header, absent from the older records
+REST_PLAIN = 64 # The JSON rest holds no fingerprint field, unset in the older records
+PHASH = struct.Struct("8s")
+SHA256_FIELD = "sha256_first_10240_bytes"
+SAMPLE_FIELD = "random_128_bytes_sample_start"
+PHASH_FIELD = "thumbnail_phash" # Kept in the JSON rest
+# Order of the fields in the decoded metadata, the order of the crawler
+FIELD_ORDER = ("url", "image_size", "etag", "timestamp", "exif", SHA256_FIELD, SAMPLE_FIELD, PHASH_FIELD)
+MAX_FIELD = 0xFFFF # Longer urls and etags go in the JSON rest
+
+def segments_folder(folder):
+    """Segments folder of a data or archive folder."""
+    return os.path.join(folder, SEGMENTS, "")
+
+def segment_paths(folder):
+    """Segment files of a segments folder, in the append order."""
+    return sorted(glob(f"{folder}*{SEGMENT_SUFFIX}"))
+
+def all_segment_paths():
+    """Segment files of the data folder and the archives."""
+    paths = []
+    for folder in settings.ARCHIVE + [settings.DATA_FOLDER]:
+        paths.extend(segment_paths(segments_folder(folder)))
+    return paths
+
+def index_path(segment_path):
+    """Sidecar index of a segment."""
+    return segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+def location(segment_path, offset):
+    """Location string of a record, used in place of a JSON file path."""
+    return f"{segment_path}#{offset}"
+
+def encode_image(metadata):
+    """Encode a metadata dict, the fields that do not fit the fixed-width fields go in the JSON rest."""
+    rest = dict(metadata)
+    flags = 0
+    url = ""
+    if isinstance(rest.get("url"), str) and len(rest["url"].encode("utf-8")) <= MAX_FIELD:
+        url = rest.pop("url")
+        flags |= HAS_URL
+    sha256 = bytes(32)
+    value = rest.get(SHA256_FIELD)
+    if isinstance(value, str) and len(value) == 64:
+        try:
+            sha256 = bytes.fromhex(value)
+            flags |= HAS_SHA256
+            del rest[SHA256_FIELD]
+        except ValueError:
+            pass
+    sample = bytes(128)
+    value = rest.get(SAMPLE_FIELD)
+    if isinstance(value, str) and len(value) == 256:
+        try:
+            sample = bytes.fromhex(value)
+            flags |= HAS_SAMPLE
+            del rest[SAMPLE_FIELD]
+        except ValueError:
+            pass
+    etag = ""
+    if "etag" in rest and (rest["etag"] is None
+                           or isinstance(rest["etag"], str) and len(rest["etag"].encode("utf-8")) <= MAX_FIELD):
+        value = rest.pop("etag")
+        if value is None:
+            flags |= ETAG_NONE
+        else:
+            flags |= HAS_ETAG
+            etag = value
+    phash = b""
+    value = rest.get(PHASH_FIELD)
+    if isinstance(value, str) and len(value) == 16:
+        try:
+            if bytes.fromhex(value).hex() == value: # Lowercase hex, decoded back as it is
+                phash = bytes.fromhex(value)
+                flags |= HAS_PHASH
+                del rest[PHASH_FIELD]
+        except ValueError:
+            pass
+    if not any(field in rest for field in ("url", "etag", SHA256_FIELD, SAMPLE_FIELD, PHASH_FIELD)):
+        flags |= REST_PLAIN
+    url_bytes = url.encode("utf-8")
+    etag_bytes = etag.encode("utf-8")
+    rest_bytes = json.dumps(rest, separators=(",", ":")).encode("utf-8") if rest else b""
+    return (IMAGE_HEADER.pack(flags, sha256, sample, len(url_bytes), len(etag_bytes), len(rest_bytes))
+            + phash + url_bytes + etag_bytes + rest_bytes)
+
+def encode_record(key, metadata_list):
+    """Encode the metadata list of a page, without the length prefix."""
+    key_bytes = key.encode("utf-8")
+    return b"".join([KEY_HEADER.pack(len(key_bytes), len(metadata_list)), key_bytes]
+                    + [encode_image(metadata) for metadata in metadata_list])
+
+def decode_images(buffer, offset, count, with_data):
+    """
+    Decode the images of a record from a buffer (mmap or bytes).
+    Yields (url, sha256 bytes or hex or None, has_etag, etag, sample bytes or hex or None, phash hex or None,
+    metadata),
+    the metadata dict only with data, the field order is FIELD_ORDER.
+    Without data, the JSON rest is skipped if it holds no fingerprint field.
+    """
+    for _ in range(count):
+        flags, sha256, sample, url_length, etag_length, rest_length = IMAGE_HEADER.unpack_from(buffer, offset)
+        offset += IMAGE_HEADER.size
+        phash = None
+        if flags & HAS_PHASH:
+            phash = PHASH.unpack_from(buffer, offset)[0].hex()
+            offset += PHASH.size
+        url = bytes(buffer[offset:offset + url_length]).decode("utf-8") if flags & HAS_URL else None
+        offset += url_length
+        etag = bytes(buffer[offset:offset + etag_length]).decode("utf-8") if flags & HAS_ETAG else None
+        offset += etag_length
+        rest = {}
+        if rest_length and (with_data or not flags & REST_PLAIN):
+            rest = json.loads(bytes(buffer[offset:offset + rest_length]))
+        offset += rest_length
+        sha256 = sha256 if flags & HAS_SHA256 else rest.get(SHA256_FIELD)
+        sample = sample if flags & HAS_SAMPLE else rest.get(SAMPLE_FIELD)
+        has_etag = bool(flags & (HAS_ETAG | ETAG_NONE)) or "etag" in rest
+        if not flags & (HAS_ETAG | ETAG_NONE):
+            etag = rest.get("etag")
+        if url is None:
+            url = rest.get("url")
+        if phash is None:
+            phash = rest.get(PHASH_FIELD)
+        metadata = None
+        if with_data:
+            fields = dict(rest)
+            if flags & HAS_URL:
+                fields["url"] = url
+            if flags & (HAS_ETAG | ETAG_NONE):
+                fields["etag"] = etag
+            if flags & HAS_SHA256:
+                fields[SHA256_FIELD] = sha256.hex()
+            if flags & HAS_SAMPLE:
+                fields[SAMPLE_FIELD] = sample.hex()
+            if flags & HAS_PHASH:
+                fields[PHASH_FIELD] = phash
+            metadata = {field: fields[field] for field in FIELD_ORDER if field in fields}
+            metadata.update(fields) # Other fields after
+        yield url, sha256, has_etag, etag, sample, phash, metadata
+
+def decode_key(buffer, offset):
+    """(key, image count, offset of the first image) of the record body at offset."""
+    key_length, count = KEY_HEADER.unpack_from(buffer, offset)
+    start = offset + KEY_HEADER.size
+    return bytes(buffer[start:start + key_length]).decode("utf-8"), count, start + key_length
+
+def map_file(file_path):
+    """Read-only mmap of a file, None if it is empty."""
+    with open(file_path, "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def record_offsets(segment_path, segment_size):
+    """
+    Offsets of the indexed records of a segment that are within its first segment_size bytes.
+    A record appended after the segment was mapped is left out.
+    """
+    try:
+        index = map_file(index_path(segment_path))
+    except OSError:
+        return []
+    if index is None:
+        return []
+    with index:
+        count = len(index) // INDEX_ENTRY.size
+        entries = [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size) for i in range(count)]
+    return [offset for offset, length in entries if offset + LENGTH.size + length <= segment_size]
+
+def iter_records(segment_paths_list, with_data=False):
+    """
+    Scan the segments, yields (location, key, images) of the last record of each key,
+    the images as decode_images() yields them.
+    The index entries are read once, the records appended during the scan are not yielded.
+    """
+    latest = {} # key -> (segment path, offset)
+    snapshot = [] # (segment path, offsets)
+    for segment_path in segment_paths_list:
+        segment = map_file(segment_path)
+        if segment is None:
+            continue
+        with segment:
+            offsets = record_offsets(segment_path, len(segment))
+            for offset in offsets:
+                key = decode_key(segment, offset + LENGTH.size)[0]
+                latest[key] = (segment_path, offset)
+        snapshot.append((segment_path, offsets))
+    for segment_path, offsets in snapshot:
+        segment = map_file(segment_path)
+        with segment:
+            for offset in offsets:
+                key, count, start = decode_key(segment, offset + LENGTH.size)
+                if latest[key] != (segment_path, offset):
+                    continue # Replaced by a later record
+                yield (location(segment_path, offset), key,
+                       list(decode_images(segment, start, count, with_data)))
+
+def iter_keys(folder):
+    """Keys of the records in a segments folder."""
+    for segment_path in segment_paths(folder):
+        segment = map_file(segment_path)
+        if segment is None:
+            continue
+        with segment:
+            for offset in record_offsets(segment_path, len(segment)):
+                yield decode_key(segment, offset + LENGTH.size)[0]
+
+class SegmentWriter:
+    """Append the page records to the segments of a folder, thread-safe."""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes # A new segment is started above this size
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        paths = segment_paths(folder)
+        self.number = len(paths)
+        if paths and os.path.getsize(paths[-1]) < max_bytes:
+            self.open(paths[-1])
+        else:
+            self.open(self.next_path())
+
+    def next_path(self):
+        """Path of a new segment."""
+        self.number += 1
+        return os.path.join(self.folder, f"segment-{self.number:06d}{SEGMENT_SUFFIX}")
+
+    def open(self, segment_path):
+        """Open a segment for appending, the bytes after the last indexed record are dropped."""
+        self.segment_path = segment_path
+        self.segment = open(segment_path, "ab")
+        self.index = open(index_path(segment_path), "ab")
+        index_size = self.index.tell() - self.index.tell() % INDEX_ENTRY.size
+        self.index.truncate(index_size) # A partly written entry
+        end = 0
+        if index_size:
+            with open(index_path(segment_path), "rb") as index:
+                index.seek(index_size - INDEX_ENTRY.size)
+                offset, length = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+            end = offset + LENGTH.size + length
+        self.segment.truncate(end) # A record without an index entry
+        self.segment.seek(end)
+
+    def append(self, key, metadata_list):
+        """Append the metadata list of a page."""
+        body = encode_record(key, metadata_list)
+        with self.lock:
+            if self.segment.tell() >= self.max_bytes:
+                self.close_files()
+                self.open(self.next_path())
+            offset = self.segment.tell()
+            self.segment.write(LENGTH.pack(len(body)) + body)
+            self.segment.flush()
+            self.index.write(INDEX_ENTRY.pack(offset, len(body)))
+            self.index.flush()
+
+    def close_files(self):
+        """Close the current segment."""
+        self.segment.close()
+        self.index.close()
+
+    def close(self):
+        """Close the writer."""
+        with self.lock:
+            self.close_files()
+
+def export_json(folder, json_folder):
+    """Write the records of the segments of a folder as <json_folder><folder>/<filename>.json files."""
+    count = 0
+    for _, key, images in iter_records(segment_paths(segments_folder(folder)), with_data=True):
+        file_path = os.path.join(json_folder, f"{key}.json")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as json_file:
+            json.dump([metadata for *_, metadata in images], json_file, indent=4)
+        count += 1
+    print(f"Exported {count} records into {json_folder}", flush=True)
+
+def import_json(json_folder, folder):
+    """Append the <json_folder>*/*.json files to the segments of a folder, the known keys are skipped."""
+    target = segments_folder(folder)
+    known = set(iter_keys(target))
+    writer = SegmentWriter(target, settings.SEGMENT_MAX_BYTES)
+    count = 0
+    try:
+        for file_path in sorted(glob(f"{json_folder}*/*.json")):
+            key = os.path.relpath(file_path, json_folder)[:-len(".json")].replace(os.sep, "/")
+            if key in known:
+                continue
+            try:
+                writer.append(key, read_json_file(file_path))
+            except Exception as error:
+                print(f"Failed to import {file_path}: {error}", flush=True)
+                continue
+            count += 1
+    finally:
+        writer.close()
+    print(f"Imported {count} JSON files into {target}", flush=True)
+
+def main(argv=None):
+    """ Main """
+    parser = argparse.ArgumentParser(description="Convert between the JSON files and the result segments.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("source", nargs="?", default=settings.DATA_FOLDER,
+                        help="export: folder of the segments folder, import: JSON folder (default DATA_FOLDER)")
+    parser.add_argument("target", nargs="?", default=settings.DATA_FOLDER,
+                        help="export: JSON folder, import: folder of the segments folder (default DATA_FOLDER)")
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        export_json(args.source, args.target)
+    else:
+        import_json(args.source, args.target)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+"""
+Fair scheduler of the crawl tasks over a fixed number of worker threads.
+The tasks are queued per domain, the domains take turns (round-robin),
+and the page tasks go before the image tasks.
+Each domain has a limit of running tasks and an optional minimum interval
+between its task starts, so one big or slow site cannot take all the workers.
+"""
+import time
+import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+
+PAGE = 0 # Task priorities, lower first
+IMAGE = 1
+PRUNE_START_TIMES = 10000 # Forget the past start times when more domains than this are tracked
+
+class DomainScheduler:
+    """Run the submitted tasks in worker threads, fairly between the domains."""
+
+    def __init__(self, workers, max_per_domain, min_interval=0.0):
+        self.max_per_domain = max_per_domain
+        self.min_interval = min_interval # Seconds between the task starts of a domain
+        self.condition = threading.Condition()
+        self.queues = (OrderedDict(), OrderedDict()) # Priority -> domain -> deque of tasks, in turn order
+        self.running = defaultdict(int) # Domain -> running tasks
+        self.next_start = {} # Domain -> earliest start time of its next task
+        self.pending = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, domain, priority, func, *args):
+        """Queue func(*args) for the domain, returns a Future of its result."""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The scheduler is shut down")
+            self.queues[priority].setdefault(domain, deque()).append((func, args, future))
+            self.pending += 1
+            self.condition.notify()
+        return future
+
+    def take(self, now):
+        """
+        Take the next task of the first domain in turn that may start one, call with the lock held.
+        Returns (domain, task, None), or (None, None, seconds to wait or None) if no task may start.
+        """
+        wait = None
+        for queues in self.queues:
+            for domain, queue in queues.items():
+                if self.running.get(domain, 0) >= self.max_per_domain:
+                    continue
+                start = self.next_start.get(domain, 0.0)
+                if start > now: # Rate limited
+                    wait = start - now if wait is None else min(wait, start - now)
+                    continue
+                task = queue.popleft()
+                if queue:
+                    queues.move_to_end(domain) # The other domains go first
+                else:
+                    del queues[domain]
+                return domain, task, None
+        return None, None, wait
+
+    def start(self, domain, now):
+        """Account a task start of the domain, call with the lock held."""
+        self.running[domain] += 1
+        self.pending -= 1
+        if self.min_interval:
+            self.next_start[domain] = now + self.min_interval
+            if len(self.next_start) > PRUNE_START_TIMES:
+                self.next_start = {other: start for other, start in self.next_start.items() if start > now}
+
+    def work(self):
+        """Worker thread loop."""
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed and not self.pending:
+                        return
+                    now = time.monotonic()
+                    domain, task, wait = self.take(now)
+                    if task is not None:
+                        break
+                    self.condition.wait(wait)
+                self.start(domain, now)
+            func, args, future = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as error:
+                    future.set_exception(error)
+            with self.condition:
+                self.running[domain] -= 1
+                if not self.running[domain]:
+                    del self.running[domain]
+                self.condition.notify_all() # A domain may start its next task
+
+    def shutdown(self, cancel=False):
+        """Run the queued tasks, or cancel them, and stop the worker threads."""
+        with self.condition:
+            self.closed = True
+            if cancel:
+                for queues in self.queues:
+                    for queue in queues.values():
+                        for _, _, future in queue:
+                            future.cancel()
+                # The workers skip the cancelled tasks
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+class DomainQuota:
+    """At most limit different image URLs per domain in a crawl."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.images = defaultdict(set) # Domain -> image URLs
+
+    def allow(self, domain, img_urls):
+        """The image URLs within the quota of the domain, the URLs already allowed are kept."""
+        allowed = []
+        with self.lock:
+            images = self.images[domain]
+            for img_url in img_urls:
+                if img_url in images or len(images) < self.limit:
+                    images.add(img_url)
+                    allowed.append(img_url)
+        return allowed
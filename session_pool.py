@@ -0,0 +1,73 @@
+"""
+Thread-safe pool of keep-alive HTTP sessions.
+Sessions are keyed by host and proxy, so the connections (and Tor circuits)
+are reused by the following requests to the same host through the same proxy.
+"""
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class SessionPool:
+    """
+    Bounded pool of idle sessions.
+    A session is checked out by one thread at a time and returned after the request.
+    At most max_idle sessions are kept in total and an idle session is closed
+    after idle_timeout seconds.
+    """
+
+    def __init__(self, max_idle=50, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = OrderedDict() # (key, id) -> (session, last used), oldest first
+        self.lock = threading.Lock()
+
+    def evict(self, now):
+        """Remove expired and surplus idle sessions, call with the lock held."""
+        expired = []
+        for idle_key, (session, last_used) in self.idle.items():
+            if now - last_used < self.idle_timeout and len(self.idle) - len(expired) <= self.max_idle:
+                break
+            expired.append(idle_key)
+        return [self.idle.pop(idle_key)[0] for idle_key in expired]
+
+    def acquire(self, key, factory):
+        """Check out an idle session for the key or create a new one with the factory."""
+        session = None
+        with self.lock:
+            for idle_key in reversed(self.idle): # Most recently used first
+                if idle_key[0] == key:
+                    session = self.idle.pop(idle_key)[0]
+                    break
+            expired = self.evict(time.monotonic())
+        for old_session in expired:
+            old_session.close()
+        return session if session is not None else factory()
+
+    def release(self, key, session):
+        """Return a session to the pool."""
+        now = time.monotonic()
+        with self.lock:
+            self.idle[(key, id(session))] = (session, now)
+            expired = self.evict(now)
+        for old_session in expired:
+            old_session.close()
+
+    @contextmanager
+    def session(self, key, factory):
+        """Context manager to borrow a session, broken sessions are not returned to the pool."""
+        session = self.acquire(key, factory)
+        try:
+            yield session
+        except Exception:
+            session.close()
+            raise
+        self.release(key, session)
+
+    def close(self):
+        """Close all idle sessions."""
+        with self.lock:
+            sessions = [session for session, _ in self.idle.values()]
+            self.idle.clear()
+        for session in sessions:
+            session.close()
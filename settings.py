@@ -14,7 +14,15 @@ PROXIES = [ # socks5h or http or https
 #    PROXIES.append({"http": f"http://127.0.0.1:{port}",
 #                    "https": f"http://127.0.0.1:{port}"})
 
+# Proxy health, an onion domain keeps its proxy unless the proxy is ejected
+PROXY_MAX_IN_FLIGHT = 20 # Requests in flight per proxy in the threads engine
+PROXY_MAX_FAILURES = 2 # Connection errors in a row before the proxy is ejected
+PROXY_RETRIES = 2 # Requests sent again after a proxy connection error, through the next proxy once ejected
+PROXY_EJECT_SECONDS = 60 # Ejection time, doubled after each ejection in a row
+PROXY_SLOW_FACTOR = 5.0 # Eject a proxy this many times slower than the median of the others
+
 # Run only a local existing data comparison
+# Each group of duplicate images in the collected data is reported once
 ONLY_COMPARE_EXISTING_DATA = False
 
 # Typical Tor Browser
@@ -28,20 +36,126 @@ assert DATA_FOLDER.endswith("/")
 ARCHIVE = ["./archive", "./sample"]  # Initial list
 ARCHIVE = [dir if dir.endswith("/") else f"{dir}/" for dir in ARCHIVE]
 
+# SQLite store of the parsed metadata files, only new or changed files are parsed at startup
+# Rebuild it with: python fingerprint_store.py
+# None parses all JSON files at every startup
+FINGERPRINT_STORE = "./fingerprints.sqlite"
+
+# Worker processes parsing the JSON metadata files at startup, 1 parses in the main process
+LOAD_PROCESSES = 1
+assert LOAD_PROCESSES > 0
+
+# detect_websites_sharing_same_images.py reads the hashes from FINGERPRINT_STORE
+# instead of parsing all JSON files (the store covers DATA_FOLDER/*/ and ARCHIVE/*/)
+DETECT_FROM_STORE = False
+
+# Incremental cross-domain report: keep the hash -> domains map in this SQLite file,
+# apply only the JSON files and result segment records changed since the last run
+# None recomputes the report from scratch
+REPORT_STORE = None # e.g. "./report.sqlite"
+REPORT_CHANGES_ONLY = True # Print only the groups that changed, False prints the full report
+REPORT_EXPORT = None # Also write the printed groups into this JSON file
+
 # Only images, no HTML parsing
 HTML_PARSING = True
+# Stop downloading a page after this many bytes, or when MAX_IMG_PER_DOMAIN image URLs are found
+HTML_MAX_BYTES = 2097152
+assert HTML_MAX_BYTES > 0
+
+# Output format of the results: "json" writes one indented JSON file per page into DATA_FOLDER/<domain>/,
+# "segments" appends compact binary records to DATA_FOLDER/segments/ (see result_segments.py)
+RESULT_FORMAT = "json"
+assert RESULT_FORMAT in ("json", "segments")
+SEGMENT_MAX_BYTES = 268435456 # A new segment file is started above this size
 
 # URL list file
 URL_FILE = "urls.txt"
 
+# SQLite index of the scanned URLs and the read position of URL_FILE
+# An interrupted crawl resumes from the saved position
+# None checks the JSON files in DATA_FOLDER and reads URL_FILE from the start
+URL_INDEX = "./scanned_urls.sqlite"
+assert URL_INDEX or RESULT_FORMAT == "json", "The segments format finds the scanned URLs in URL_INDEX"
+
 # List of local image files to test
 TEST_IMAGES_FOLDER = "./test_images/"
 assert TEST_IMAGES_FOLDER.endswith("/")
 
 # Define the number of parallel download threads
+# The threads engine runs CRAWL_WORKERS threads, the asyncio engine parses and saves in MAX_THREADS threads
 MAX_THREADS = 10
 assert MAX_THREADS > 0
 assert MAX_THREADS < 110
 
-# Max images per a domain to download
+# Scheduler of the threads engine: one queue of page and image tasks run by CRAWL_WORKERS threads
+# The domains take turns, the pages go before the images
+# The default keeps the thread count of the old MAX_THREADS pages with MAX_THREADS images each
+CRAWL_WORKERS = MAX_THREADS * MAX_THREADS # Worker threads, and pages in progress at the same time
+assert CRAWL_WORKERS > 0
+assert CRAWL_WORKERS <= 1000, "Each worker is an OS thread, lower MAX_THREADS or set CRAWL_WORKERS"
+DOMAIN_MAX_IN_FLIGHT = 4 # Tasks running at the same time per domain
+DOMAIN_MIN_INTERVAL = 0.0 # Seconds between the task starts of a domain, 0 is no limit
+
+# Keep-alive HTTP sessions, reused per host and proxy
+SESSION_POOL_SIZE = 50 # Max idle sessions kept open
+SESSION_IDLE_TIMEOUT = 60 # Close sessions idle for more than this many seconds
+
+# Fetch the image size, etag and the first 10KB with a single ranged GET request
+# The HEAD request is sent only if the size is not in the GET response
+SINGLE_REQUEST_FETCH = True
+
+# Crawl engine: "threads" (ThreadPoolExecutor) or "asyncio" (aiohttp, see async_crawler.py)
+CRAWL_ENGINE = "threads"
+assert CRAWL_ENGINE in ("threads", "asyncio")
+
+# Concurrency limits of the asyncio engine
+ASYNC_MAX_REQUESTS = 1000 # Requests in flight in total
+ASYNC_MAX_PER_HOST = 10 # Requests in flight per host
+ASYNC_MAX_PER_PROXY = 100 # Requests in flight per Tor proxy
+ASYNC_MAX_PAGES = 100 # URLs of URL_FILE crawled at the same time
+
+# Adaptive probing: fetch a small first range, then at most one follow-up range
+# covering the rest of the fingerprint and the whole JPEG metadata segments
+# The fingerprint always needs the first 10240 bytes and the kept images are above MIN_IMAGE_SIZE,
+# so it saves no bytes: it costs a second request per image to read metadata larger than 10KB
+ADAPTIVE_PROBE = False
+ADAPTIVE_PROBE_SIZE = 4096 # Bytes of the first range
+ADAPTIVE_MAX_BYTES = 262144 # Never fetch more than this from the start of an image
+assert ADAPTIVE_MAX_BYTES > 10240
+
+# SQLite cache of the image fingerprints with their etag and Last-Modified headers, e.g. "./fetch_cache.sqlite"
+# Re-crawls send If-None-Match/If-Modified-Since and reuse the fingerprint on 304 Not Modified
+# The image start is not downloaded again, so a cached image is not matched by the 128-byte sample
+# None disables the cache
+FETCH_CACHE = None
+FETCH_CACHE_SIZE = 1000000 # Entries, the least recently used are evicted
+FETCH_CACHE_TTL = 30 * 24 * 3600 # Seconds, older entries are downloaded again
+FETCH_CACHE_FRESH = 3600 # Seconds, newer entries are reused without a request
+
+# Extract EXIF metadata in worker processes, 0 extracts in the download threads
+# The workers are started with forkserver (spawn where it is not available), not fork,
+# a script importing metadata_fetcher must call main() under if __name__ == "__main__"
+EXIF_PROCESSES = 0
+EXIF_BATCH_SIZE = 32 # Image starts sent to a worker process at once
+EXIF_BATCH_WAIT = 0.02 # Seconds to wait for a batch to fill up
+
+# Near-duplicate detection: perceptual hash (pHash) of the EXIF thumbnail found in the first bytes of an image
+# A re-encoded or re-saved copy is reported when its thumbnail hash differs in at most this many of the 64 bits
+THUMBNAIL_HASH = True
+THUMBNAIL_MAX_DISTANCE = 10
+assert 0 <= THUMBNAIL_MAX_DISTANCE < 64
+
+# Instrumentation: call count, errors and latency histogram of each crawl stage per domain and proxy,
+# and the byte and cache counters, written to METRICS_FILE every METRICS_INTERVAL seconds
+# None disables it, a stage then costs one function call
+METRICS_FILE = None # e.g. "./metrics.json"
+METRICS_FORMAT = "json" # "json" or "prometheus" (text exposition format)
+assert METRICS_FORMAT in ("json", "prometheus")
+METRICS_INTERVAL = 10 # Seconds between the exports
+METRICS_MAX_DOMAINS = 1000 # Domain labels, the next domains are counted as "other", 0 drops the domain label
+# cProfile of a random sample of the image fetches, accumulated into this file (python -m pstats <file>)
+PROFILE_FILE = None # e.g. "./profile.pstats", needs METRICS_FILE
+PROFILE_SAMPLE_RATE = 0.01
+
+# Max images per a domain to download, counted over all the HTML pages of the domain
 MAX_IMG_PER_DOMAIN = 30
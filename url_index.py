@@ -0,0 +1,190 @@
+"""
+Streaming URL ingestion with a persistent index of the scanned URLs.
+A URL is scanned when its results are saved into DATA_FOLDER/<folder>/<filename>.json,
+the index keeps the same "<folder>/<filename>" keys in SQLite, with a Bloom filter in front of it.
+The read position of the URL file is checkpointed, an interrupted crawl resumes from there.
+"""
+import os
+import sqlite3
+import threading
+from glob import glob
+from hashlib import blake2b
+import result_segments
+
+BLOOM_HASHES = 7 # Hash functions per key
+BLOOM_BITS_PER_KEY = 10 # About 1% false positives
+CHECKPOINT_EVERY = 100 # Save the read position after this many finished URLs
+CHECKPOINT_WINDOW = 4096 # Bytes before the read position hashed with it, a replaced file restarts from 0
+SCHEMA_VERSION = 2 # The checkpoints of older stores are dropped
+
+class BloomFilter:
+    """Bloom filter of string keys, no false negatives."""
+
+    def __init__(self, capacity):
+        self.size = max(1 << 20, capacity * BLOOM_BITS_PER_KEY) # Bits
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        """Bit positions of a key, double hashing."""
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(BLOOM_HASHES)]
+
+    def add(self, key):
+        """Add a key."""
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+def window_digest(file_path, offset):
+    """Hash of the CHECKPOINT_WINDOW bytes before the offset, they stay the same when lines are appended."""
+    window_start = max(0, offset - CHECKPOINT_WINDOW)
+    with open(file_path, "rb") as file:
+        file.seek(window_start)
+        return blake2b(file.read(offset - window_start), digest_size=16).digest()
+
+class ScannedUrlIndex:
+    """
+    Exact SQLite store of the scanned keys, with a Bloom filter for fast negative lookups.
+    A new store is seeded from the JSON files and the segment records already in the data folder.
+    """
+
+    def __init__(self, store_path, data_folder):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(store_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scanned (key TEXT PRIMARY KEY)")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0: # New store
+            keys = [os.path.relpath(path, data_folder)[:-len(".json")]
+                    for path in glob(f"{data_folder}*/*.json")]
+            keys.extend(result_segments.iter_keys(result_segments.segments_folder(data_folder)))
+            self.connection.executemany("INSERT OR IGNORE INTO scanned (key) VALUES (?)",
+                                        [(key,) for key in keys])
+        if version != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS checkpoints")
+            self.connection.execute(
+                "CREATE TABLE checkpoints (path TEXT PRIMARY KEY, offset INTEGER NOT NULL, digest BLOB NOT NULL)")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.connection.commit()
+        count = self.connection.execute("SELECT COUNT(*) FROM scanned").fetchone()[0]
+        self.bloom = BloomFilter(2 * count)
+        for (key,) in self.connection.execute("SELECT key FROM scanned"):
+            self.bloom.add(key)
+
+    def __contains__(self, key):
+        if key not in self.bloom:
+            return False # Definitely not scanned
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM scanned WHERE key = ?", (key,)).fetchone() is not None
+
+    def add(self, key):
+        """Mark a key scanned."""
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO scanned (key) VALUES (?)", (key,))
+            self.connection.commit()
+            self.bloom.add(key)
+
+    def checkpoint(self, file_path):
+        """Saved read position of the URL file and the window_digest() at it, (0, None) if there is none."""
+        with self.lock:
+            row = self.connection.execute("SELECT offset, digest FROM checkpoints WHERE path = ?",
+                                          (os.path.abspath(file_path),)).fetchone()
+        return row if row else (0, None)
+
+    def save_checkpoint(self, file_path, offset, digest=None):
+        """Save the read position of the URL file with its window_digest(), 0 removes it."""
+        with self.lock:
+            if offset:
+                self.connection.execute("INSERT OR REPLACE INTO checkpoints (path, offset, digest) VALUES (?, ?, ?)",
+                                        (os.path.abspath(file_path), offset, digest))
+            else:
+                self.connection.execute("DELETE FROM checkpoints WHERE path = ?", (os.path.abspath(file_path),))
+            self.connection.commit()
+
+    def close(self):
+        """Close the store."""
+        with self.lock:
+            self.connection.close()
+
+class UrlFeed:
+    """
+    Generator of the new URLs of a URL file, in the file order, read line by line.
+    Call done(url) when a URL is finished, the read position before the oldest
+    unfinished URL is checkpointed, so an interrupted crawl resumes from there.
+    Without an index, the scanned URLs are detected from the data folder files.
+    """
+
+    def __init__(self, file_path, key_for_url, data_folder, index=None):
+        self.file_path = file_path
+        self.key_for_url = key_for_url # url -> "<folder>/<filename>"
+        self.data_folder = data_folder
+        self.index = index
+        self.lock = threading.Lock()
+        self.in_flight = {} # key -> start offset of the line, in file order
+        self.read_offset = 0 # End of the last line read
+        self.finished = 0
+        self.count = 0
+
+    def is_scanned(self, key):
+        """Check if the results of the URL are already saved."""
+        if self.index is not None:
+            return key in self.index
+        return os.path.isfile(f"{self.data_folder}{key}.json")
+
+    def __iter__(self):
+        start, digest = self.index.checkpoint(self.file_path) if self.index is not None else (0, None)
+        if start and window_digest(self.file_path, start) != digest: # The file was replaced or edited
+            print(f"{self.file_path} changed before the saved position, reading it from the start", flush=True)
+            start = 0
+        if start:
+            print(f"Resuming {self.file_path} from byte {start}", flush=True)
+        with open(self.file_path, "rb") as file:
+            file.seek(start)
+            offset = start
+            for raw_line in file:
+                line_start, offset = offset, offset + len(raw_line)
+                line = raw_line.decode("utf-8", errors="ignore")
+                if not line.startswith('http'):
+                    continue
+                url = line.split()[0].strip()
+                try:
+                    key = self.key_for_url(url)
+                except Exception as error:
+                    print(f"Invalid URL {url}: {error}", flush=True)
+                    continue
+                with self.lock:
+                    self.read_offset = offset
+                    if key in self.in_flight:
+                        continue # Duplicate of a URL in progress
+                if self.is_scanned(key):
+                    continue # Already downloaded
+                with self.lock:
+                    self.in_flight[key] = line_start
+                self.count += 1
+                yield url
+        with self.lock:
+            self.read_offset = offset
+        if not self.count:
+            print(f"No new (not already scanned) URLs in a file: {self.file_path}", flush=True)
+        else:
+            print(f"Loaded {self.count} new URLs from a file: {self.file_path}", flush=True)
+
+    def done(self, url):
+        """Mark a URL finished, successful or not, and checkpoint now and then."""
+        with self.lock:
+            self.in_flight.pop(self.key_for_url(url), None)
+            self.finished += 1
+            save = self.finished % CHECKPOINT_EVERY == 0
+        if save:
+            self.save_checkpoint()
+
+    def save_checkpoint(self, complete=False):
+        """Save the position before the oldest unfinished URL, a complete pass clears it."""
+        if self.index is None:
+            return
+        with self.lock:
+            offset = 0 if complete else min(self.in_flight.values()) if self.in_flight else self.read_offset
+        self.index.save_checkpoint(self.file_path, offset, window_digest(self.file_path, offset) if offset else None)